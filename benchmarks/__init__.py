@@ -0,0 +1 @@
+"""Benchmarks for the bot, run with `python -m benchmarks.<name>`"""
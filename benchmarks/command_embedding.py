@@ -0,0 +1,94 @@
+"""
+Benchmark startup and stanza-switch latency of embedding command phrases,
+one phrase at a time versus batched. Every round starts with an empty
+embedding cache, as a restart or a switch to an unheard song does; a first
+run also starts with an empty on-disk store.
+
+Usage: `python -m benchmarks.command_embedding`
+"""
+
+import tempfile
+import time
+
+import torch
+
+from benchmarks.command_matching import PHRASES
+from bot.commands import embeddings
+from bot.commands.commands import Command, CommandHandler
+from bot.commands.embeddings import embed
+from irc.message import Message
+from music.music import SongInfo, Stanza
+
+STANZA = Stanza("Viva la Vida", "Coldplay", "2008", "rock", "i used to rule the world")
+
+
+def per_phrase(commands: list[Command]) -> None:
+    """The old path: every phrase through the model on its own"""
+    for command in commands:
+        if not command.stale:
+            continue
+        if command.phrases:
+            command.set_embeddings(torch.stack([embed(p) for p in command.phrases]))
+        else:
+            command.set_embeddings(None)
+
+
+def build_handler() -> CommandHandler:
+    """Command handler with TweetyBot's commands, not yet embedded"""
+    ch = CommandHandler()
+    for phrases in PHRASES[:7]:
+        ch.add_command(Command(phrases, lambda _: None))
+    for answer_type in SongInfo:
+        ch.add_command(Command([], lambda _: None, answer_type=answer_type))
+    ch.new_message(Message(content="i used to rule the world"))
+    return ch
+
+
+def forget() -> None:
+    """Drop the embeddings cached in memory"""
+    embeddings.embedding_cache.clear()
+
+
+def first_run() -> None:
+    """Drop the cached embeddings and start an empty on-disk store"""
+    forget()
+    embeddings.STORE_DIR = tempfile.mkdtemp()
+    embeddings.embedding_store = None
+
+
+def timed(name: str, fn, setup, rounds: int = 10) -> None:
+    """Report the mean latency of `fn`, calling `setup` untimed before each call"""
+    setup()
+    fn()  # warm up
+    total = 0.0
+    for _ in range(rounds):
+        setup()
+        begin = time.perf_counter()
+        fn()
+        total += time.perf_counter() - begin
+    print(f"{name:>28}: {total / rounds * 1e3:.1f} ms")
+
+
+def stanza_switch(ch: CommandHandler, batched: bool) -> None:
+    """Switch to a new stanza, re-embedding the answer phrases"""
+    if batched:
+        ch.new_stanza(STANZA)
+    else:
+        ch.embed_pending = lambda: per_phrase(ch.commands)  # type: ignore
+        ch.new_stanza(STANZA)
+
+
+if __name__ == "__main__":
+    first_run()
+    timed(
+        "first run, per phrase", lambda: per_phrase(build_handler().commands), first_run
+    )
+    timed("first run, batched", lambda: build_handler().embed_pending(), first_run)
+    timed("restart, batched", lambda: build_handler().embed_pending(), forget)
+
+    handler = build_handler()
+    handler.embed_pending()
+    timed("stanza switch, batched", lambda: stanza_switch(handler, True), forget)
+    legacy = build_handler()
+    legacy.embed_pending()
+    timed("stanza switch, per phrase", lambda: stanza_switch(legacy, False), forget)
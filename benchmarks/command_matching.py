@@ -0,0 +1,91 @@
+"""
+Benchmark per-message command matching latency. Each message starts with an
+empty embedding cache, as a new chat line does.
+
+Usage: `python -m benchmarks.command_matching`
+"""
+
+import time
+
+from bot.commands import embeddings
+from bot.commands.commands import Command, CommandHandler
+from bot.commands.embeddings import most_similar
+from irc.message import Message
+
+# the soft command phrases TweetyBot registers
+PHRASES = [
+    ["hello", "hi", "hey", "whats up"],
+    ["purpose", "What do you do?", "What is your purpose?", "Why are you here?"],
+    ["remember me", "Do you remember me?", "Do you know me?", "Who am I?"],
+    ["song name", "What song was that?", "What is that song called?"],
+    ["song artist", "who sang", "Who sings that song?", "Who wrote that song?"],
+    ["song year", "when", "song release date", "When did it come out?"],
+    ["song genre", "What genre is that song?", "What kind of song is that?"],
+    ["Viva la Vida", "It's called Viva la Vida", "Is it Viva la Vida?"],
+    ["Coldplay", "It's by Coldplay", "Is it Coldplay?", "Is the artist Coldplay?"],
+    ["2008", "It was released in 2008", "Was it released in 2008?"],
+    ["rock", "It's rock", "Is it rock?", "Is the genre rock?"],
+]
+
+QUERIES = [
+    "what was that song",
+    "who made it?",
+    "is it by coldplay",
+    "hey there tweety",
+    "i think it came out in 2008",
+    "what kind of music is that",
+]
+
+
+def build_handler() -> CommandHandler:
+    """Command handler with TweetyBot's command set"""
+    ch = CommandHandler()
+    for phrases in PHRASES:
+        ch.add_command(Command(phrases, lambda _: None))
+    ch.embed_pending()
+    return ch
+
+
+def per_command_embedding(ch: CommandHandler, phrase: str) -> None:
+    """The old matching loop, which embedded the message once per command"""
+    for command in ch.commands:
+        if command.phrase_embedings is not None:
+            # it predates the embedding cache
+            embeddings.embedding_cache.clear()
+            most_similar(phrase, command.phrase_embedings)
+
+
+def per_command_loop(ch: CommandHandler, phrase: str) -> None:
+    """Embedding once, but comparing against each command in a Python loop"""
+    ch.new_message(Message(content=phrase))
+    query = ch.context.message_embedding()
+    for command in ch.commands:
+        if command.phrase_embedings is not None:
+            most_similar(query, command.phrase_embedings)
+
+
+def fused_index(ch: CommandHandler, phrase: str) -> None:
+    """The current `closest_command`, one product over the fused phrase index"""
+    ch.new_message(Message(content=phrase))
+    ch.closest_command(threshold=0.2, min_diff=0.005)
+
+
+def timed(name: str, fn, ch: CommandHandler, rounds: int = 20) -> None:
+    """Report mean per-message latency of `fn`"""
+    fn(ch, QUERIES[0])  # warm up
+    total = 0.0
+    for _ in range(rounds):
+        for query in QUERIES:
+            embeddings.embedding_cache.clear()
+            begin = time.perf_counter()
+            fn(ch, query)
+            total += time.perf_counter() - begin
+    per_message = total / (rounds * len(QUERIES))
+    print(f"{name:>24}: {per_message * 1e3:.2f} ms/message")
+
+
+if __name__ == "__main__":
+    handler = build_handler()
+    timed("embed per command", per_command_embedding, handler)
+    timed("embed once, loop commands", per_command_loop, handler)
+    timed("fused phrase index", fused_index, handler)
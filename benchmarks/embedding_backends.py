@@ -0,0 +1,77 @@
+"""
+Compare the embedding backends on accuracy and latency: per-text vector
+agreement, whether `closest_command` makes the same decision for a fixed
+phrase set, and encode latency.
+
+Usage: `python -m benchmarks.embedding_backends` (needs onnxruntime)
+"""
+
+import time
+
+import numpy as np
+
+from benchmarks.command_matching import QUERIES, build_handler
+from bot.commands import embeddings as em
+from bot.commands.backends import BACKENDS, create_backend
+from irc.message import Message
+
+EXTRA_QUERIES = [
+    "who sings this",
+    "what year is it from",
+    "do you remember me",
+    "why are you here",
+    "is it rock music",
+    "i have no idea",
+]
+
+
+def decisions(kind: str) -> list[str | None]:
+    """`closest_command` outcome of each query with a backend"""
+    em.use_backend(kind)
+    ch = build_handler()
+    outcome = []
+    for query in QUERIES + EXTRA_QUERIES:
+        ch.new_message(Message(content=query))
+        command = ch.closest_command(threshold=0.2, min_diff=0.005)
+        outcome.append(command.get_last_matched_phrase() if command else None)
+    return outcome
+
+
+def latency(kind: str, texts: list[str], rounds: int = 20) -> tuple[float, float]:
+    """Mean seconds per single-text encode and per batched encode"""
+    backend = create_backend(kind, em.MODEL_NAME)
+    backend.encode(texts)  # warm up
+    begin = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            backend.encode([text])
+    single = (time.perf_counter() - begin) / (rounds * len(texts))
+    begin = time.perf_counter()
+    for _ in range(rounds):
+        backend.encode(texts)
+    return single, (time.perf_counter() - begin) / rounds
+
+
+if __name__ == "__main__":
+    texts = QUERIES + EXTRA_QUERIES
+    reference = create_backend("torch", em.MODEL_NAME).encode(texts)
+    for kind in BACKENDS:
+        vectors = create_backend(kind, em.MODEL_NAME).encode(texts)
+        cosines = (reference * vectors).sum(1) / (
+            np.linalg.norm(reference, axis=1) * np.linalg.norm(vectors, axis=1)
+        )
+        single, batch = latency(kind, texts)
+        print(
+            f"{kind:>6}: {single * 1e3:.2f} ms/text, {batch * 1e3:.2f} ms/batch "
+            + f"of {len(texts)}, min cosine to torch {cosines.min():.4f}"
+        )
+
+    expected = decisions("torch")
+    for kind in BACKENDS:
+        got = decisions(kind)
+        mismatches = [
+            (q, e, g) for q, e, g in zip(texts, expected, got) if e != g
+        ]
+        print(f"{kind:>6}: {len(texts) - len(mismatches)}/{len(texts)} decisions match")
+        for query, want, have in mismatches:
+            print(f"        {query!r}: {want!r} != {have!r}")
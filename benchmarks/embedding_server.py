@@ -0,0 +1,79 @@
+"""
+Throughput of the embedding server against its batch window, under
+synthetic concurrent load: many client threads each sending single-text
+requests, as busy bot instances would.
+
+Usage: `python -m benchmarks.embedding_server [CLIENTS] [REQUESTS]`
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from bot.commands import embeddings as em
+from bot.commands.backends import RemoteBackend, create_backend
+from bot.commands.server import EmbeddingServer
+
+WINDOWS_MS = [0, 1, 2, 5, 10, 20]
+
+
+def start_server(server: EmbeddingServer, path: str):
+    """Run the server on its own event loop thread, returning a stop function"""
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(server.serve(path))
+
+    def run() -> None:
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+
+    def stop() -> None:
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join()
+
+    return stop
+
+
+def load(path: str, clients: int, requests: int) -> float:
+    """Seconds for `clients` threads to each get `requests` embeddings"""
+    client = RemoteBackend(em.MODEL_NAME, path)
+
+    def worker(i: int) -> None:
+        for j in range(requests):
+            client.encode([f"client {i} says line number {j} of the chat"])
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - begin
+
+
+if __name__ == "__main__":
+    n_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    n_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    backend = create_backend(em.BACKEND, em.MODEL_NAME)
+    backend.encode(["warm up"])
+
+    for window in WINDOWS_MS:
+        socket_path = os.path.join(tempfile.mkdtemp(), "embed.sock")
+        embedding_server = EmbeddingServer(backend, window / 1e3)
+        stop_server = start_server(embedding_server, socket_path)
+        elapsed = load(socket_path, n_clients, n_requests)
+        total = n_clients * n_requests
+        print(
+            f"window {window:>3} ms: {total / elapsed:8.1f} texts/s, "
+            + f"mean batch {embedding_server.texts / embedding_server.batches:5.1f}"
+        )
+        stop_server()
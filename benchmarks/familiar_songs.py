@@ -0,0 +1,73 @@
+"""
+Benchmark `MusicHandler.get_familiar_songs` against the old implementation
+(Python list of postings + Counter), on phrases mixing the index's most common
+terms with random ones. On indexes without repeated postings, also check that
+both return the same verses when no words are skipped.
+
+Usage: `python -m benchmarks.familiar_songs [-i music/inverse_index]`
+"""
+
+import argparse
+import random
+import time
+from collections import Counter
+
+from music.index import INDEX_DIR, InvertedIndex
+from music.music import MusicHandler
+
+PHRASES = 200
+COMMON = 2
+RARE = 4
+
+
+def get_familiar_songs(phrase, inverse_index):
+    """The old implementation"""
+    songs = []
+    for word in phrase.lower().split():
+        if word in inverse_index:
+            songs.extend(inverse_index[word].tolist())
+
+    counter = Counter(songs)
+    most_common = counter.most_common(1)
+    if len(most_common) == 0:
+        return []
+    max_count = most_common[0][1]
+    return [item for item, count in counter.items() if count == max_count]
+
+
+def make_phrases(index: InvertedIndex, count: int) -> list[str]:
+    """Chat-like phrases: a few very common terms plus a few random ones"""
+    rng = random.Random(0)
+    lengths = index.offsets[1:] - index.offsets[:-1]
+    common = [index.terms[i] for i in lengths.argsort()[::-1][:50]]
+    return [
+        " ".join(rng.sample(common, COMMON) + rng.sample(index.terms, RARE))
+        for _ in range(count)
+    ]
+
+
+def timed(fn, phrases: list[str]) -> float:
+    """Mean seconds per phrase of `fn`"""
+    begin = time.perf_counter()
+    for phrase in phrases:
+        fn(phrase)
+    return (time.perf_counter() - begin) / len(phrases)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-i", "--index", default=INDEX_DIR, help="index directory")
+    args = parser.parse_args()
+
+    index = InvertedIndex(args.index)
+    handler = MusicHandler(max_df=None)
+    phrases = make_phrases(index, PHRASES)
+    for phrase in phrases:
+        new = handler.get_familiar_songs(phrase, index).tolist()
+        assert new == get_familiar_songs(phrase, index), phrase
+
+    old = timed(lambda phrase: get_familiar_songs(phrase, index), phrases)
+    new = timed(lambda phrase: handler.get_familiar_songs(phrase, index), phrases)
+    print(f"{len(index)} terms, {len(index.postings)} postings, {PHRASES} phrases")
+    print(f"Counter : {old * 1e3:8.3f} ms/phrase")
+    print(f"planned : {new * 1e3:8.3f} ms/phrase  ({old / new:.1f}x)")
@@ -0,0 +1,53 @@
+"""
+Measure the import cost of the bot's modules with `python -X importtime`, and
+check that importing them doesn't pull in heavy dependencies.
+
+Usage: `python -m benchmarks.import_time`
+"""
+
+import subprocess
+import sys
+
+MODULES = [
+    "irc.message",
+    "music.setup",
+    "bot.commands.commands",
+    "music.music",
+    "bot.tweety",
+]
+
+HEAVY = ["torch", "sentence_transformers", "pandas", "nltk", "numpy"]
+
+
+def import_cost(module: str) -> tuple[int, list[str]]:
+    """Cumulative import time (us) of `module` and the heavy modules it loaded"""
+    check = (
+        f"import sys, {module}; "
+        + f"print(' '.join(m for m in {HEAVY!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", check],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+    cumulative = 0
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            cumulative = int(parts[1])
+    return cumulative, result.stdout.split()
+
+
+if __name__ == "__main__":
+    for name in MODULES:
+        try:
+            us, heavy = import_cost(name)
+        except ImportError as e:
+            print(f"{name:>22}: failed to import ({e})")
+            continue
+        loaded = ", ".join(heavy) if heavy else "none"
+        print(f"{name:>22}: {us / 1e3:8.1f} ms  heavy modules loaded: {loaded}")
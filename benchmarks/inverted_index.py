@@ -0,0 +1,82 @@
+"""
+Compare loading the song index with `json.load` against opening the
+memory-mapped binary index: load time and resident memory, each measured in a
+fresh interpreter, plus the latency of looking up a phrase's postings.
+
+Usage: `python -m benchmarks.inverted_index [-i music/inverse_index.json]`
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+from music.index import INDEX_DIR, JSON_PATH
+
+LOADERS = {
+    "json.load": (
+        "import json\n"
+        "with open({json_path!r}) as f:\n"
+        "    index = json.load(f)\n"
+    ),
+    "InvertedIndex": (
+        "from music.index import InvertedIndex\n"
+        "index = InvertedIndex({index_dir!r})\n"
+    ),
+}
+
+PROBE = """
+import os, random, time, timeit
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+before = rss()
+begin = time.perf_counter()
+{load}
+elapsed = time.perf_counter() - begin
+after = rss()
+
+terms = random.Random(0).sample(sorted(index), 8)
+rounds = 200
+lookup = timeit.timeit(lambda: [list(index[term]) for term in terms], number=rounds)
+print(elapsed, after - before, lookup / rounds)
+"""
+
+
+def measure(loader: str, json_path: str, index_dir: str) -> tuple[float, int, float]:
+    """Load seconds, RSS growth in bytes and lookup seconds of `loader`"""
+    load = LOADERS[loader].format(json_path=json_path, index_dir=index_dir)
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(load=load)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    seconds, rss, lookup = result.stdout.split()
+    return float(seconds), int(rss), float(lookup)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-i", "--input", default=JSON_PATH, help="JSON index")
+    parser.add_argument("-o", "--output", default=INDEX_DIR, help="index directory")
+    args = parser.parse_args()
+
+    from music.index import InvertedIndex
+
+    index = InvertedIndex.open(args.output, args.input)
+    print(f"{len(index)} terms, {len(index.postings)} postings")
+    with open(args.input) as f:
+        assert all(
+            index[term].tolist() == postings for term, postings in json.load(f).items()
+        )
+
+    for name in LOADERS:
+        seconds, rss, lookup = measure(name, args.input, args.output)
+        print(
+            f"{name:>14}: load {seconds * 1e3:8.1f} ms  "
+            + f"RSS +{rss / 2**20:7.1f} MiB  "
+            + f"8 lookups {lookup * 1e6:7.1f} us"
+        )
@@ -0,0 +1,60 @@
+"""
+Benchmark the incremental line parser against the old per-chunk regex split.
+
+Usage: `python -m benchmarks.irc_stream [LOG]`, where `LOG` is a recorded raw
+channel log (one IRC line per line). Without a log, a synthetic high-volume
+channel is generated.
+"""
+
+import random
+import re
+import sys
+import time
+
+from irc.stream import LineBuffer
+
+CHUNK = 2040
+
+
+def legacy_split(chunk: bytes) -> list[str]:
+    """The parser `IRC.get_response` used, applied to a single chunk"""
+    resp = chunk.decode("UTF-8", errors="replace").lstrip()
+    raw_messages = re.findall(r"(:.*?)(?=:\n|$)", resp, re.DOTALL | re.MULTILINE)
+    return [m.replace("\n", "") for m in raw_messages if m]
+
+
+def synthetic_log(lines: int = 200_000) -> bytes:
+    """Generate a busy channel with mixed line lengths"""
+    rng = random.Random(582)
+    words = "never an honest word and that was when i ruled the world".split()
+    out = []
+    for i in range(lines):
+        text = " ".join(rng.choices(words, k=rng.randint(1, 40)))
+        out.append(f":user{i % 97}!u@host PRIVMSG #CSC582 :{text}\r\n")
+    return "".join(out).encode()
+
+
+def run(name: str, data: bytes, parse) -> int:
+    """Feed `data` through `parse` in recv-sized chunks"""
+    view = memoryview(data)
+    count = 0
+    begin = time.perf_counter()
+    for offset in range(0, len(data), CHUNK):
+        count += len(parse(view[offset : offset + CHUNK]))
+    elapsed = time.perf_counter() - begin
+    mb = len(data) / 1e6
+    print(f"{name:>12}: {elapsed:.3f}s ({mb / elapsed:.1f} MB/s), {count} lines")
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            log = f.read().replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+    else:
+        log = synthetic_log()
+
+    expected = log.count(b"\n")
+    run("legacy", log, lambda chunk: legacy_split(bytes(chunk)))
+    got = run("LineBuffer", log, LineBuffer().feed)
+    assert got == expected, f"LineBuffer lost lines ({got} != {expected})"
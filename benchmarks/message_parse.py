@@ -0,0 +1,55 @@
+"""
+Microbenchmark of per-message parse cost: the old regex-per-message parser
+against the single-pass `irc.message.Message` parser.
+
+Usage: `python -m benchmarks.message_parse`
+"""
+
+import re
+import timeit
+
+from irc import constants as c
+from irc.message import Message
+
+CHANNEL = c.CHANNELS[0]
+
+LINES = [
+    f":alice!a@host PRIVMSG {CHANNEL} :never an honest word",
+    f":bob!b@host PRIVMSG {CHANNEL} :{c.NICKNAME}: what song was that?",
+    f"@time=2024-02-12T10:00:00.000Z;msgid=abc :carol!c@host PRIVMSG {CHANNEL} :hi",
+    ":server.example 353 Tweety-bot = #CSC582 :alice bob carol",
+    ":dave!d@host JOIN #CSC582",
+]
+
+
+def legacy(raw_message: str):
+    """The old `Message.parse` followed by the old `is_for_bot`/`is_priv` pair"""
+    error_match = re.match(r"^ERROR(?:\s*:(?P<content>.*))?$", raw_message)
+    if error_match is not None:
+        return None
+    sender_match = re.match(r"^:([A-Za-z0-9-_@&$()/]+)!.*$", raw_message)
+    main_match = re.search(
+        rf".*PRIVMSG {CHANNEL} :(?:(?P<target>[^\s]+):\s*)?(?P<content>.*)\s*$",
+        raw_message,
+    )
+    sender = sender_match.group(1) if sender_match else None
+    target = main_match.group("target") if main_match else None
+    is_priv = "PRIVMSG" in raw_message and CHANNEL in raw_message and sender
+    is_for_bot = "PRIVMSG" in raw_message and CHANNEL in raw_message and sender
+    return is_priv, is_for_bot and target == c.NICKNAME
+
+
+def current(raw_message: str):
+    """The single-pass parser and its cached predicates"""
+    message = Message(raw_message)
+    return message.is_priv(), message.is_for_bot()
+
+
+if __name__ == "__main__":
+    for name, fn in [("legacy", legacy), ("single-pass", current)]:
+        runs = 20_000
+        total = min(
+            timeit.repeat(lambda: [fn(line) for line in LINES], number=runs, repeat=5)
+        )
+        per_message = total / (runs * len(LINES)) * 1e6
+        print(f"{name:>12}: {per_message:.2f} us/message")
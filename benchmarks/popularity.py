@@ -0,0 +1,49 @@
+"""
+Microbenchmark of picking the most viewed candidate and its percentile: the
+old pandas `iloc` + `sort_values` + `searchsorted` against `argmax` over the
+views array and the precomputed percentile ranks, for 1 to 10k candidates.
+
+Usage: `python -m benchmarks.popularity`
+"""
+
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from music.music import MusicHandler, percentile_ranks
+
+SONGS = 300_000
+CANDIDATES = [1, 10, 100, 1_000, 10_000]
+
+
+def legacy(song_ids, df):
+    """The old `get_most_popular_song` followed by `get_song_percentile`"""
+    verse = df.iloc[song_ids].sort_values("views", ascending=False).iloc[0]
+    views_col = df["views"]
+    return verse, views_col.values.searchsorted(verse["views"]) / len(views_col) * 100
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"views": rng.integers(0, 10**8, SONGS)})
+    handler = MusicHandler()
+    handler.views = df["views"].to_numpy()
+    handler.percentiles = percentile_ranks(handler.views)
+
+    def current(song_ids):
+        song_id = int(handler.get_most_popular_songs(song_ids, handler.views, 1)[0])
+        return song_id, handler.get_song_percentile(song_id)
+
+    print(f"{SONGS} songs")
+    for count in CANDIDATES:
+        song_ids = rng.choice(SONGS, count, replace=False).astype(np.uint32)
+        verse, _ = legacy(song_ids, df)
+        assert verse["views"] == handler.views[current(song_ids)[0]]
+        runs = 200
+        old = timeit.timeit(lambda: legacy(song_ids, df), number=runs) / runs
+        new = timeit.timeit(lambda: current(song_ids), number=runs) / runs
+        print(
+            f"{count:>6} candidates: pandas {old * 1e6:8.1f} us  "
+            + f"numpy {new * 1e6:6.1f} us  ({old / new:.0f}x)"
+        )
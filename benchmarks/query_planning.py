@@ -0,0 +1,128 @@
+"""
+Replay a chat log through the verse search and report the latency
+distribution of `get_familiar_songs`: every word scored (the bincount search),
+rarest words first with early stopping (the default), and additionally
+reading at most `CAP` of the verses' postings per word. Also reports how
+often each plan picks the same verses as the full search.
+
+The log holds raw IRC lines (only PRIVMSG contents are replayed) or plain
+messages, one per line. Without a log, chat-like phrases are made up from the
+index's vocabulary, half of them random words and half quotes of verses with
+a few common words mixed in.
+
+Usage: `python -m benchmarks.query_planning [-i music/inverse_index] [-s music/songs]
+[-l chat.log]`
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from benchmarks.familiar_songs import COMMON, make_phrases
+from irc.message import Message
+from music.index import INDEX_DIR, InvertedIndex, unique_in_order
+from music.music import MusicHandler
+from music.songs import STORE_DIR, SongStore
+from music.text import TOKEN, tokenize
+
+PHRASES = 1000
+# Consecutive words of a verse in a made-up quote
+QUOTE = 4
+# Fraction of the verses whose postings the capped plan reads per word
+CAP = 0.05
+PERCENTILES = [50, 90, 99, 100]
+
+
+def full_search(phrase: str, index: InvertedIndex):
+    """Score every word's postings, without query planning"""
+    postings = []
+    for word in tokenize(phrase, index.apostrophes):
+        if word in index:
+            postings.append(index[word])
+    if len(postings) == 0:
+        return np.empty(0, dtype=np.uint32)
+    song_ids = np.concatenate(postings)
+    counts = np.bincount(song_ids)
+    return unique_in_order(song_ids[counts[song_ids] == counts.max()])
+
+
+def make_quotes(index: InvertedIndex, songs: SongStore, count: int) -> list[str]:
+    """Chat-like quotes: a few consecutive words of a verse and common terms"""
+    rng = random.Random(1)
+    lengths = index.offsets[1:] - index.offsets[:-1]
+    common = [index.terms[i] for i in lengths.argsort()[::-1][:50]]
+    quotes = []
+    while len(quotes) < count:
+        words = TOKEN.findall(songs.verse(rng.randrange(len(songs))))
+        if len(words) < QUOTE:
+            continue
+        begin = rng.randrange(len(words) - QUOTE + 1)
+        quote = rng.sample(common, COMMON) + words[begin : begin + QUOTE]
+        quotes.append(" ".join(quote))
+    return quotes
+
+
+def read_log(path: str) -> list[str]:
+    """Message contents of the chat log at `path`"""
+    phrases = []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            message = Message(line)
+            if message.command == "PRIVMSG":
+                line = message.content or ""
+            if line.strip():
+                phrases.append(line)
+    return phrases
+
+
+def replay(search, phrases: list[str]) -> tuple[np.ndarray, list]:
+    """Latencies in seconds and results of `search` over `phrases`"""
+    latencies, results = [], []
+    for phrase in phrases:
+        begin = time.perf_counter()
+        results.append(search(phrase))
+        latencies.append(time.perf_counter() - begin)
+    return np.array(latencies), results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-i", "--index", default=INDEX_DIR, help="index directory")
+    parser.add_argument("-s", "--songs", default=STORE_DIR, help="song store")
+    parser.add_argument("-l", "--log", help="chat log to replay")
+    args = parser.parse_args()
+
+    index = InvertedIndex(args.index)
+    if args.log:
+        phrases = read_log(args.log)
+    else:
+        songs = SongStore(args.songs)
+        phrases = make_phrases(index, PHRASES // 2)
+        phrases += make_quotes(index, songs, PHRASES - len(phrases))
+
+    tokenize("warm up the stemmer")
+    early = MusicHandler(max_df=None)
+    capped = MusicHandler(max_df=CAP)
+    plans = {
+        "full": lambda phrase: full_search(phrase, index),
+        "rare first": lambda phrase: early.get_familiar_songs(phrase, index),
+        f"cap {CAP:g}": lambda phrase: capped.get_familiar_songs(phrase, index),
+    }
+
+    print(f"{len(index)} terms, {len(index.postings)} postings, {len(phrases)} lines")
+    header = "  ".join(f"p{p:<3}" if p < 100 else "max " for p in PERCENTILES)
+    print(f"{'plan':>12}  {header}  (ms)  same verses")
+    baseline = None
+    for name, search in plans.items():
+        search(phrases[0])  # warm up
+        latencies, results = replay(search, phrases)
+        found = [set(result.tolist()) for result in results]
+        baseline = baseline or found
+        same = np.mean([a == b for a, b in zip(found, baseline)])
+        cells = "  ".join(
+            f"{np.percentile(latencies, p) * 1e3:4.2f}" for p in PERCENTILES
+        )
+        print(f"{name:>12}  {cells}        {same:6.1%}")
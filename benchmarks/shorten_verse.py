@@ -0,0 +1,70 @@
+"""
+Cost of picking the line of a candidate verse that best matches a message:
+the old per-call `re.split` + `tokenize` of every line of the verse, against
+the line table precomputed in the song store, over the candidates the index
+returns for a chat log (or synthetic phrases, as in `benchmarks.familiar_songs`).
+
+Usage: `python -m benchmarks.shorten_verse [-l chat.log]`
+"""
+
+import argparse
+import time
+
+from benchmarks.query_planning import read_log
+from benchmarks.familiar_songs import make_phrases
+from music.music import MusicHandler, RERANK_K
+from music.songs import LINE_BREAK
+from music.text import tokenize
+
+PHRASES = 200
+# Candidates shortened per message, as in `MusicHandler.next_stanza`
+CANDIDATES = RERANK_K
+
+
+def legacy(phrase: str, verse: str):
+    """The old `shorten_verse`, tokenizing every line of the verse per call"""
+    words = tokenize(phrase)
+    best_count, best_line = 0, None
+    for line in LINE_BREAK.split(verse):
+        line_words = set(tokenize(line))
+        count = sum(1 for word in words if word in line_words)
+        if count > best_count:
+            best_count, best_line = count, line
+    return best_line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-l", "--log", help="chat log to replay")
+    args = parser.parse_args()
+
+    handler = MusicHandler()
+    handler.load()
+    phrases = (
+        read_log(args.log)
+        if args.log
+        else make_phrases(handler.inverse_index, PHRASES)
+    )
+    pairs = [
+        (phrase, int(song_id))
+        for phrase in phrases
+        for song_id in handler.get_verses(
+            phrase, handler.inverse_index, handler.views
+        )[:CANDIDATES]
+    ]
+    print(f"{len(phrases)} messages, {len(pairs)} candidate verses")
+
+    for phrase, song_id in pairs:
+        expected = legacy(phrase, handler.songs.verse(song_id))
+        assert handler.shorten_verse(phrase, song_id) == expected, (phrase, song_id)
+
+    begin = time.perf_counter()
+    for phrase, song_id in pairs:
+        legacy(phrase, handler.songs.verse(song_id))
+    old = (time.perf_counter() - begin) / max(1, len(pairs))
+    begin = time.perf_counter()
+    for phrase, song_id in pairs:
+        handler.shorten_verse(phrase, song_id)
+    new = (time.perf_counter() - begin) / max(1, len(pairs))
+    print(f"re.split + tokenize (old): {old * 1e6:7.1f} us/verse")
+    print(f"line table               : {new * 1e6:7.1f} us/verse")
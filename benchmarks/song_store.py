@@ -0,0 +1,95 @@
+"""
+Compare the song DataFrame (`pd.read_csv`) against the columnar `SongStore`:
+load time, resident and anonymous memory after 1000 lookups, each measured
+in a fresh interpreter, and the latency of reading one song's fields by row id.
+
+Usage: `python -m benchmarks.song_store [-i music/exploded_song_df.csv]`
+"""
+
+import argparse
+import subprocess
+import sys
+
+from music.songs import CSV_PATH, STORE_DIR
+
+FIELDS = ["title", "artist", "year", "genre", "views", "verse"]
+
+LOADERS = {
+    "DataFrame": (
+        "import pandas\n"
+        "songs = pandas.read_csv({csv_path!r})\n"
+        "def lookup(i):\n"
+        "    row = songs.iloc[i]\n"
+        f"    return [row[field] for field in {FIELDS!r}]\n"
+    ),
+    "SongStore": (
+        "from music.songs import SongStore\n"
+        "songs = SongStore({store_dir!r})\n"
+        "def lookup(i):\n"
+        "    row = songs.row(i)\n"
+        f"    return [row[field] for field in {FIELDS!r}]\n"
+    ),
+}
+
+PROBE = """
+import os, random, time, timeit
+import numpy, pandas
+
+def memory():
+    # Resident bytes, and those of them not backed by a file, which can't be
+    # shared with other processes or dropped under memory pressure
+    fields = {{}}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                fields[name] = int(value.split()[0]) * 1024
+    return fields["Rss"], fields["Anonymous"]
+
+rss, anonymous = memory()
+begin = time.perf_counter()
+{load}
+elapsed = time.perf_counter() - begin
+
+ids = random.Random(0).choices(range(len(songs)), k=1000)
+latency = timeit.timeit(lambda: [lookup(i) for i in ids], number=5) / 5000
+after_rss, after_anonymous = memory()
+print(elapsed, after_rss - rss, after_anonymous - anonymous, latency)
+"""
+
+
+def measure(
+    loader: str, csv_path: str, store_dir: str
+) -> tuple[float, int, int, float]:
+    """
+    Load seconds, RSS and anonymous memory growth in bytes after 1000 lookups,
+    and seconds per lookup of `loader`
+    """
+    load = LOADERS[loader].format(csv_path=csv_path, store_dir=store_dir)
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(load=load)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    seconds, rss, anonymous, latency = result.stdout.split()
+    return float(seconds), int(rss), int(anonymous), float(latency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-i", "--input", default=CSV_PATH, help="song CSV")
+    parser.add_argument("-o", "--output", default=STORE_DIR, help="store directory")
+    args = parser.parse_args()
+
+    from music.songs import SongStore
+
+    store = SongStore.open(args.output, args.input)
+    print(f"{len(store)} songs")
+    for name in LOADERS:
+        seconds, rss, anonymous, latency = measure(name, args.input, args.output)
+        print(
+            f"{name:>10}: load {seconds * 1e3:8.1f} ms  "
+            + f"RSS +{rss / 2**20:7.1f} MiB (anonymous +{anonymous / 2**20:6.1f})  "
+            + f"lookup {latency * 1e6:6.1f} us"
+        )
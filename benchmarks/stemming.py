@@ -0,0 +1,62 @@
+"""
+Stemming cost per chat message: the old whole-phrase `PorterStemmer.stem`
+call, per-token stemming without a cache, and the memoized `music.tokenize`
+pipeline, replayed over a chat log (or the sample lines below, repeated).
+
+Usage: `python -m benchmarks.stemming [-l chat.log]`
+"""
+
+import argparse
+import time
+
+from benchmarks.query_planning import read_log
+from music.text import TOKEN, get_stemmer, stem, tokenize
+
+LINES = [
+    "never an honest word",
+    "Tweety-bot: Viva la Vida!",
+    "Tweety-bot: by Coldplay, right?",
+    "Tweety-bot: do you know me?",
+    "all around me are familiar faces, worn-out places",
+    "Tweety-bot: is that mad world?",
+    "Tweety-bot: Who's it by?",
+    "Tweety-bot: When did it come out?",
+    "I used to rule the world",
+    "seas would rise when I gave the word",
+    "hello darkness my old friend, I've come to talk with you again",
+    "lol i've been listening to that song all day",
+]
+REPEATS = 100
+
+
+def timed(fn, phrases: list[str]) -> float:
+    """Mean seconds per phrase of `fn`"""
+    begin = time.perf_counter()
+    for phrase in phrases:
+        fn(phrase)
+    return (time.perf_counter() - begin) / len(phrases)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-l", "--log", help="chat log to replay")
+    args = parser.parse_args()
+
+    phrases = read_log(args.log) if args.log else LINES * REPEATS
+    stemmer = get_stemmer()
+    stemmer.stem("warm up")
+
+    def uncached(phrase: str) -> list[str]:
+        return [stemmer.stem(token) for token in TOKEN.findall(phrase.lower())]
+
+    old = timed(stemmer.stem, phrases)
+    per_token = timed(uncached, phrases)
+    stem.cache_clear()
+    memoized = timed(tokenize, phrases)
+    info = stem.cache_info()
+
+    print(f"{len(phrases)} messages")
+    print(f"whole phrase (old): {old * 1e6:7.1f} us/message")
+    print(f"per token         : {per_token * 1e6:7.1f} us/message")
+    print(f"per token, cached : {memoized * 1e6:7.1f} us/message", end="  ")
+    print(f"({info.hits / (info.hits + info.misses):.0%} hits)")
@@ -0,0 +1,61 @@
+"""
+Benchmark batched top-k similarity search (`embeddings.top_k`) against the
+old single-query `similarity_rankings`, over matrices of 10 to 1M rows.
+
+Usage: `python -m benchmarks.top_k`
+"""
+
+import time
+
+import torch
+import torch.nn.functional as F
+
+from bot.commands.embeddings import normalize, top_k
+
+DIM = 384
+ROWS = [10, 100, 1_000, 10_000, 100_000, 1_000_000]
+QUERIES = 32
+K = 5
+
+
+def similarity_rankings(single, matrix, k=None):
+    """The old implementation: one query, full argsort, Python list of scalars"""
+    single = single.unsqueeze(0)
+    cosine_similarity_matrix = F.cosine_similarity(
+        single.unsqueeze(1), matrix.unsqueeze(0), dim=2
+    )
+    rankings = list(
+        torch.argsort(cosine_similarity_matrix, dim=1, descending=True).squeeze(0)
+    )
+    rankings = rankings[:k] if k else rankings
+    cosines = [cosine_similarity_matrix.squeeze(0)[i] for i in rankings]
+    return rankings, cosines
+
+
+def timed(fn, rounds: int) -> float:
+    """Mean seconds per call of `fn`"""
+    fn()
+    begin = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - begin) / rounds
+
+
+if __name__ == "__main__":
+    torch.manual_seed(582)
+    queries = torch.randn(QUERIES, DIM)
+    print(f"{'rows':>9} {'legacy/query':>14} {'top_k/query':>13} {'batched/query':>15}")
+    for rows in ROWS:
+        matrix = normalize(torch.randn(rows, DIM))
+        rounds = max(1, 20_000 // rows)
+        if rows <= 100_000:
+            legacy = timed(lambda: similarity_rankings(queries[0], matrix, K), rounds)
+            legacy_str = f"{legacy * 1e3:11.3f} ms"
+        else:
+            legacy_str = f"{'(skipped)':>14}"
+        single = timed(lambda: top_k(queries[0], matrix, K, normalized=True), rounds)
+        batched = timed(lambda: top_k(queries, matrix, K, normalized=True), rounds)
+        print(
+            f"{rows:>9} {legacy_str} {single * 1e3:10.3f} ms "
+            + f"{batched / QUERIES * 1e3:12.3f} ms"
+        )
@@ -0,0 +1,113 @@
+"""
+Recall vs latency of the IVF verse index (`music.semantic.VerseIndex`) on
+synthetic clustered embeddings, against an exact brute-force scan of the
+memory-mapped matrix. Queries are perturbed copies of random verses, standing
+in for paraphrased lyrics.
+
+The budget is `BUDGET_MS` per query at the default `NPROBE` on 1M verses.
+
+Usage: `python -m benchmarks.verse_ann [-n 1000000] [-d /tmp]`
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from music.semantic import NPROBE, VerseIndex, build, unit
+
+DIM = 384
+# Verses per topic; a verse's true neighbors are mostly the verses of its topic
+TOPIC_SIZE = 20
+# Per-dimension noise around a verse's topic, and between a verse and its query
+NOISE = 0.04
+QUERY_NOISE = 0.02
+QUERIES = 200
+K = 10
+NPROBES = [1, 2, 4, 8, 16, 32, 64]
+BUDGET_MS = 10.0
+CHUNK = 65_536
+
+
+def make_vectors(path: str, rows: int, seed: int = 0):
+    """Write `rows` normalized float32 embeddings around random topics"""
+    rng = np.random.default_rng(seed)
+    shape = (max(1, rows // TOPIC_SIZE), DIM)
+    topics = unit(rng.standard_normal(shape, dtype=np.float32))
+    vectors = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=(rows, DIM)
+    )
+    for begin in range(0, rows, CHUNK):
+        count = min(CHUNK, rows - begin)
+        chunk = topics[rng.integers(0, len(topics), count)]
+        chunk += NOISE * rng.standard_normal((count, DIM), dtype=np.float32)
+        vectors[begin : begin + count] = unit(chunk)
+    vectors.flush()
+    return np.load(path, mmap_mode="r")
+
+
+def exact(vectors, queries) -> np.ndarray:
+    """Ids of the true top `K` of each query, by scanning every vector"""
+    best_scores = np.full((len(queries), K), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), K), dtype=np.int64)
+    for begin in range(0, len(vectors), CHUNK):
+        chunk = np.asarray(vectors[begin : begin + CHUNK], np.float32)
+        chunk_ids = np.broadcast_to(
+            np.arange(begin, begin + len(chunk)), (len(queries), len(chunk))
+        )
+        scores = np.concatenate([best_scores, queries @ chunk.T], axis=1)
+        ids = np.concatenate([best_ids, chunk_ids], axis=1)
+        top = np.argpartition(-scores, K - 1, axis=1)[:, :K]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+    return best_ids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", type=int, default=1_000_000, help="number of verses")
+    parser.add_argument("-d", default=tempfile.gettempdir(), help="scratch directory")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.d)
+    begin = time.perf_counter()
+    vectors = make_vectors(os.path.join(directory, "vectors.npy"), args.n)
+    elapsed = time.perf_counter() - begin
+    print(f"{args.n} verses x {DIM} dims: generated in {elapsed:.0f} s")
+
+    begin = time.perf_counter()
+    build(vectors, os.path.join(directory, "index"))
+    index = VerseIndex(os.path.join(directory, "index"))
+    elapsed = time.perf_counter() - begin
+    print(f"IVF index, {len(index.centroids)} clusters: built in {elapsed:.0f} s")
+
+    rng = np.random.default_rng(1)
+    targets = rng.integers(0, args.n, QUERIES)
+    queries = np.asarray(vectors[np.sort(targets)], np.float32)
+    noise = QUERY_NOISE * rng.standard_normal(queries.shape, np.float32)
+    queries = unit(queries + noise)
+
+    begin = time.perf_counter()
+    truth = exact(vectors, queries)
+    scan_ms = (time.perf_counter() - begin) / QUERIES * 1e3
+    print(f"{'exact scan':>10}: recall@{K} 100.0%  mean {scan_ms:7.2f} ms (batched)")
+
+    for nprobe in NPROBES:
+        latencies, found = [], 0
+        for query, true_ids in zip(queries, truth):
+            begin = time.perf_counter()
+            _, ids = index.search(query, K, nprobe)
+            latencies.append(time.perf_counter() - begin)
+            found += len(np.intersect1d(ids, true_ids))
+        latencies = np.array(latencies) * 1e3
+        p99 = np.percentile(latencies, 99)
+        print(
+            f"nprobe {nprobe:>3}: recall@{K} {found / truth.size:6.1%}  "
+            + f"mean {latencies.mean():7.2f} ms  p99 {p99:7.2f} ms"
+            + (f"  (default, budget {BUDGET_MS:g} ms)" if nprobe == NPROBE else "")
+        )
+
+    shutil.rmtree(directory)
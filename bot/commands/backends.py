@@ -0,0 +1,251 @@
+"""Interchangeable models for computing text embeddings"""
+
+from __future__ import annotations
+
+import inspect
+import json
+import os
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from .helpers import lazy_import
+
+np = lazy_import("numpy")
+
+# Where the exported, quantized ONNX model is kept
+ONNX_DIR = "cache/onnx"
+
+# How long the remote backend waits for the embedding server, and how long it
+# stays on its in-process fallback before trying the server again
+REMOTE_TIMEOUT = 10.0
+REMOTE_RETRY = 30.0
+
+# Backend the remote client runs in-process while the server is unreachable.
+# Its vectors are stored under the same name as the server's, so the server
+# must run this backend too; the client won't use a server running another.
+REMOTE_FALLBACK = "torch"
+
+
+class EmbeddingBackend(ABC):
+    """Interface for a model that turns texts into embedding vectors"""
+
+    # Identifies the vectors a backend produces (e.g. for the on-disk store)
+    name = "backend"
+
+    @abstractmethod
+    def encode(self, texts: list[str]) -> np.ndarray:
+        """
+        Embed a batch of texts.
+        Args:
+        - `texts` (`list[str]`): The texts to embed.
+        Returns:
+        - `numpy.ndarray`: A float32 matrix with one row per text.
+        """
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """The full-precision PyTorch SentenceTransformer model"""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+
+        self.name = backend_name("torch", model_name)
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        return self.model.encode(texts)
+
+
+class OnnxBackend(EmbeddingBackend):
+    """
+    The same model exported to ONNX, with int8 dynamically quantized weights,
+    run on the CPU through onnxruntime. The export is created on first use.
+    """
+
+    def __init__(self, model_name: str, path: str | None = None):
+        try:
+            import onnxruntime as ort
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError(
+                "The onnx backend needs onnxruntime: pip install onnx onnxruntime"
+            ) from e
+
+        self.name = backend_name("onnx", model_name)
+        self.path = path or onnx_path(model_name)
+        if not os.path.exists(self.path):
+            export_onnx(model_name, self.path)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            self.path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        tokens = self.tokenizer(
+            texts, padding=True, truncation=True, max_length=256, return_tensors="np"
+        )
+        inputs = {
+            name: ids.astype(np.int64)
+            for name, ids in tokens.items()
+            if name in self.input_names
+        }
+        hidden = self.session.run(None, inputs)[0]
+
+        # mean pooling over real tokens, then L2 normalization, as the
+        # SentenceTransformer pipeline does
+        mask = tokens["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return (pooled / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+
+class RemoteBackend(EmbeddingBackend):
+    """
+    Client of a local embedding server (see `bot.commands.server`). Falls
+    back to running the model in-process while the server is unreachable,
+    answers with an error or runs a different backend than the fallback.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        path: str | None = None,
+        fallback: str = REMOTE_FALLBACK,
+    ):
+        from . import server
+
+        self.server = server
+        # named after the model that actually computes the vectors, whether
+        # the server or the fallback, as both run the same one
+        self.name = backend_name(fallback, model_name)
+        self.model_name = model_name
+        self.path = path or server.SOCKET_PATH
+        self.fallback_kind = fallback
+        self.fallback: EmbeddingBackend | None = None
+        self.down_until = 0.0
+        self.local = threading.local()  # one connection per thread
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        if time.monotonic() >= self.down_until:
+            try:
+                return self.request(texts)
+            except (OSError, ValueError) as e:
+                # error replies and garbled frames count as a server down too
+                self.close()
+                self.down_until = time.monotonic() + REMOTE_RETRY
+                print(f"[Embedding server unavailable ({e}), running in-process]")
+
+        if self.fallback is None:
+            self.fallback = create_backend(self.fallback_kind, self.model_name)
+        return self.fallback.encode(texts)
+
+    def request(self, texts: list[str]) -> np.ndarray:
+        """Send one request to the server and wait for its vectors"""
+        sock = getattr(self.local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(REMOTE_TIMEOUT)
+            sock.connect(self.path)
+            self.local.sock = sock
+
+        sock.sendall(self.server.frame(json.dumps(texts).encode()))
+        header = json.loads(self.read_frame(sock))
+        if "error" in header:
+            raise ConnectionError(f"server error: {header['error']}")
+        if header.get("model") != self.name:
+            # drop the unread vectors along with the connection
+            raise ConnectionError(
+                f"server runs {header.get('model')}, expected {self.name}"
+            )
+        vectors = np.frombuffer(self.read_frame(sock), dtype=np.float32)
+        return vectors.reshape(header["shape"])
+
+    def read_frame(self, sock: socket.socket) -> bytes:
+        """Read one length-prefixed frame (internal use only)"""
+        prefix = self.read_exactly(sock, self.server.FRAME.size)
+        (size,) = self.server.FRAME.unpack(prefix)
+        return self.read_exactly(sock, size)
+
+    @staticmethod
+    def read_exactly(sock: socket.socket, size: int) -> bytes:
+        """Read exactly `size` bytes (internal use only)"""
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("embedding server closed the connection")
+            data += chunk
+        return bytes(data)
+
+    def close(self) -> None:
+        """Close this thread's connection to the server"""
+        sock = getattr(self.local, "sock", None)
+        if sock is not None:
+            sock.close()
+            self.local.sock = None
+
+
+def backend_name(kind: str, model_name: str) -> str:
+    """
+    Name of the vectors a backend of `kind` produces (see
+    `EmbeddingBackend.name`), without loading it
+    """
+    if kind == "remote":
+        return backend_name(REMOTE_FALLBACK, model_name)
+    return model_name if kind == "torch" else f"{model_name}@{kind}"
+
+
+def onnx_path(model_name: str) -> str:
+    """Location of a model's quantized ONNX export"""
+    return os.path.join(ONNX_DIR, model_name.split("/")[-1] + "-int8.onnx")
+
+
+def export_onnx(model_name: str, path: str) -> None:
+    """Export a model to ONNX and quantize its weights to int8"""
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+
+    print(f"Exporting {model_name} to {path}...")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    model = AutoModel.from_pretrained(model_name).eval()
+    sample = AutoTokenizer.from_pretrained(model_name)(["hello"], return_tensors="pt")
+    # the inputs are passed positionally, so in the order `forward` takes them
+    parameters = inspect.signature(model.forward).parameters
+    names = [name for name in parameters if name in sample]
+    fp32_path = path.replace(".onnx", "-fp32.onnx")
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in names),
+            fp32_path,
+            input_names=names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                name: {0: "batch", 1: "sequence"}
+                for name in names + ["last_hidden_state"]
+            },
+            opset_version=14,
+        )
+    quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+    os.remove(fp32_path)
+
+
+BACKENDS = {
+    "torch": SentenceTransformerBackend,
+    "onnx": OnnxBackend,
+    "remote": RemoteBackend,
+}
+
+
+def create_backend(kind: str, model_name: str) -> EmbeddingBackend:
+    """Create an embedding backend by name (one of `BACKENDS`)"""
+    assert kind in BACKENDS, f"Unknown embedding backend {kind!r}"
+    return BACKENDS[kind](model_name)
@@ -1,14 +1,18 @@
 """Command handler for the bot"""
 
-from typing import Callable
+from __future__ import annotations
 
-import torch
+import copy
+from typing import Callable
 
 from irc import Message
 from music.music import SongInfo, Stanza
 
 from . import helpers
-from .embeddings import embed, most_similar
+from .embeddings import embed, embed_batch
+
+torch = helpers.lazy_import("torch")
+F = helpers.lazy_import("torch.nn.functional")
 
 
 class Context:
@@ -16,6 +20,7 @@ class Context:
 
     def __init__(self):
         self.latest_message: Message | None = None
+        self.latest_embedding: torch.Tensor | None = None
         self.cur_stanza: Stanza | None = None
         self.cur_rhet: SongInfo | None = None
         self.cur_rhet_target: str | None = None
@@ -23,6 +28,15 @@ class Context:
     def update_latest_message(self, msg: Message) -> None:
         """Set the latest message"""
         self.latest_message = msg
+        self.latest_embedding = None
+
+    def message_embedding(self) -> torch.Tensor:
+        """Embedding of the latest message, computed at most once per message"""
+        if self.latest_embedding is None:
+            assert self.latest_message is not None
+            assert self.latest_message.content is not None
+            self.latest_embedding = embed(self.latest_message.content)
+        return self.latest_embedding
 
     def update_rhetorical(self, rhet: SongInfo, target: str | None) -> None:
         """Set the current rhetorical question"""
@@ -54,7 +68,9 @@ class Command:
         self.callback = callback
         self.exact = exact
         self.context: Context | None = None
-        self.phrase_embedings = self.embeddings()
+        self.version = 0
+        self.phrase_embedings: torch.Tensor | None = None
+        self.stale = True  # phrases changed since they were last embedded
         self.lmp_idx: int | None = None
         self.already_ran = False
         self.answer_type = answer_type
@@ -66,18 +82,35 @@ class Command:
         """Get the phrase embeddings"""
         if len(self.phrases) == 0:
             return None
-        return torch.stack([embed(phrase) for phrase in self.phrases])
+        return embed_batch(self.phrases)
+
+    def set_embeddings(self, embeddings: torch.Tensor | None) -> None:
+        """Set the phrase embeddings (computed elsewhere, e.g. in a batch)"""
+        self.phrase_embedings = embeddings
+        self.stale = False
+        self.version += 1
 
     def update_embeddings(self) -> None:
         """Update the phrase embeddings"""
-        self.phrase_embedings = self.embeddings()
+        self.set_embeddings(self.embeddings())
 
     def update_phrases(self, phrases: list[str]) -> None:
-        """Update the phrases"""
+        """Update the phrases, to be embedded with the next batch"""
         self.phrases = phrases
-        self.update_embeddings()
+        self.stale = True
         self.already_ran = False
 
+    def copy(self) -> Command:
+        """
+        Copy the command with fresh state, sharing the (read-only) phrase
+        embeddings instead of recomputing them
+        """
+        command = copy.copy(self)
+        command.context = None
+        command.lmp_idx = None
+        command.already_ran = False
+        return command
+
     def run(self, *args, **kwargs):
         """Run the command, remove if `run_once` is `True`"""
         return self.callback(*args, **kwargs)
@@ -89,13 +122,139 @@ class Command:
         return None
 
 
+def embed_commands(commands: list[Command]) -> None:
+    """
+    Embed the phrases of every stale command, in a single batch per kind:
+    the fixed phrases of regular commands are persisted to the on-disk store,
+    while the answers built from each stanza are not, as they rarely recur
+    """
+    stale = [command for command in commands if command.stale]
+    for persist in (True, False):
+        group = [c for c in stale if (c.answer_type is None) == persist]
+        phrases = [phrase for command in group for phrase in command.phrases]
+        embeddings = embed_batch(phrases, persist=persist) if phrases else None
+
+        offset = 0
+        for command in group:
+            count = len(command.phrases)
+            if count == 0 or embeddings is None:
+                command.set_embeddings(None)
+            else:
+                command.set_embeddings(embeddings[offset : offset + count])
+            offset += count
+
+
+class PhraseIndex:
+    """
+    Pre-normalized embeddings of every soft command's phrases, stacked into
+    one matrix, with the command each row belongs to
+    """
+
+    def __init__(self):
+        self.commands: list[Command] = []
+        self.blocks: list[torch.Tensor | None] = []
+        self.versions: list[int] = []
+        self.starts: list[int] = []
+        self.matrix: torch.Tensor | None = None
+        self.owners: torch.Tensor | None = None
+
+    def add(self, command: Command) -> None:
+        """Add a command's phrases to the index"""
+        self.commands.append(command)
+        self.blocks.append(None)
+        self.versions.append(-1)
+        self.starts.append(0)
+
+    def refresh(self) -> None:
+        """
+        Re-normalize the phrases of commands that changed since the last
+        lookup, and rebuild the matrix from the first changed command onwards
+        """
+        embed_commands(self.commands)
+
+        first_changed = None
+        for i, command in enumerate(self.commands):
+            if self.versions[i] == command.version:
+                continue
+            emb = command.phrase_embedings
+            self.blocks[i] = None if emb is None else F.normalize(emb, dim=1)
+            self.versions[i] = command.version
+            if first_changed is None:
+                first_changed = i
+
+        if first_changed is None:
+            return
+
+        lengths = [0 if b is None else len(b) for b in self.blocks]
+        start = 0
+        if first_changed > 0:
+            start = self.starts[first_changed - 1] + lengths[first_changed - 1]
+        kept = [] if self.matrix is None else [self.matrix[:start]]
+        for i in range(first_changed, len(self.blocks)):
+            self.starts[i] = start
+            start += lengths[i]
+
+        tail = [b for b in self.blocks[first_changed:] if b is not None]
+        rows = kept + tail
+        self.matrix = torch.cat(rows) if sum(len(r) for r in rows) > 0 else None
+        self.owners = torch.repeat_interleave(
+            torch.arange(len(self.blocks)), torch.tensor(lengths)
+        )
+
+    def top2(
+        self, query: torch.Tensor
+    ) -> tuple[Command, int, float, float | None] | None:
+        """
+        Score every phrase against a query embedding in one product and reduce
+        to the best score per command.
+        Args:
+        - `query` (`torch.Tensor`): The embedding to compare.
+        Returns:
+        - `tuple[Command, int, float, float | None] | None`: The best command,
+          the index of its matched phrase, its score, and the best score of
+          any other command (`None` if no other command has phrases), or
+          `None` if no command has phrases.
+        """
+        self.refresh()
+        if self.matrix is None:
+            return None
+        assert self.owners is not None
+
+        scores = self.matrix @ F.normalize(query, dim=0)
+        per_command = torch.full(
+            (len(self.blocks),), float("-inf"), dtype=scores.dtype
+        ).scatter_reduce(0, self.owners, scores, reduce="amax")
+        best = per_command.topk(min(2, len(self.blocks)))
+
+        row = int(scores.argmax())
+        slot = int(self.owners[row])
+        max_score = float(best.values[0])
+        next_max_score = float(best.values[1]) if len(best.values) > 1 else None
+        if next_max_score == float("-inf"):
+            next_max_score = None
+        return self.commands[slot], row - self.starts[slot], max_score, next_max_score
+
+
 class CommandHandler:
     """Class for handling commands"""
 
     def __init__(self):
         self.commands: list[Command] = []
+        self.index = PhraseIndex()
         self.context = Context()
 
+    def fork(self) -> CommandHandler:
+        """Create a handler with copies of these commands and a fresh context"""
+        self.embed_pending()
+        handler = CommandHandler()
+        for command in self.commands:
+            handler.add_command(command.copy())
+        return handler
+
+    def embed_pending(self) -> None:
+        """Embed the phrases of all commands that changed, in one batch"""
+        embed_commands(self.commands)
+
     def reset(self) -> None:
         """Reset the command handler"""
         for command in self.commands:
@@ -165,6 +324,7 @@ class CommandHandler:
                 continue
             phrases = answer_phrases[command.answer_type]
             command.update_phrases(phrases)
+        self.embed_pending()
 
         if rhetorical:
             self.context.update_rhetorical(
@@ -190,69 +350,53 @@ class CommandHandler:
         phrase = self.context.latest_message.content
         assert isinstance(phrase, str)
 
-        sim_scores: list[float] = []
-        phrase_idxs: list[int] = []
-
         exact_commands = [c for c in self.commands if c.exact]
         soft_commands = [c for c in self.commands if not c.exact]
 
+        simple_phrase = helpers.simplify(phrase)
+
         # check for exact matches
 
         for command in exact_commands:
-            if command.phrase_embedings is None:
-                continue
-            if helpers.simplify(phrase) in command.phrases:
-                idx = command.phrases.index(helpers.simplify(phrase))
+            if simple_phrase in command.phrases:
+                idx = command.phrases.index(simple_phrase)
                 command.lmp_idx = idx
                 return command
 
         # no exact matches, check for soft matches
 
-        if len(soft_commands) == 0:
-            return None
-
         for command in soft_commands:
-            if command.phrase_embedings is None:
-                continue
-            if helpers.simplify(phrase) in command.phrases:
-                idx = command.phrases.index(helpers.simplify(phrase))
+            if simple_phrase in command.phrases:
+                idx = command.phrases.index(simple_phrase)
                 command.lmp_idx = idx
                 return command
-            idx, score = most_similar(phrase, command.phrase_embedings)
-            sim_scores.append(score)
-            phrase_idxs.append(idx)
-
-        max_score = max(sim_scores)
-        max_command_idx = sim_scores.index(max_score)
-        meets_thresh_req = sim_scores[max_command_idx] >= threshold
 
-        if not meets_thresh_req:
-            print(f"!threshold ({sim_scores[max_command_idx]} < {threshold})")
+        # score all phrases of all commands at once, embedding the message once
+        match = self.index.top2(self.context.message_embedding())
+        if match is None:
             return None
+        command, phrase_idx, max_score, next_max_score = match
 
-        if len(sim_scores) == 1:
-            command = soft_commands[max_command_idx]
-            command.lmp_idx = phrase_idxs[max_command_idx]
-            return command
+        if max_score < threshold:
+            print(f"!threshold ({max_score} < {threshold})")
+            return None
 
-        # get index of second highest score
-        next_max_score = max(
-            sim_scores[:max_command_idx] + sim_scores[max_command_idx + 1 :]
-        )
-        meets_diff_req = max_score - next_max_score >= min_diff
+        if next_max_score is not None:
+            meets_diff_req = max_score - next_max_score >= min_diff
 
-        if not meets_diff_req:
-            print(f"!min_diff ({max_score - next_max_score} < {min_diff})")
-            return None
+            if not meets_diff_req:
+                print(f"!min_diff ({max_score - next_max_score} < {min_diff})")
+                return None
 
-        command = soft_commands[max_command_idx]
-        command.lmp_idx = phrase_idxs[max_command_idx]
+        command.lmp_idx = phrase_idx
         return command
 
     def add_command(self, command: Command) -> None:
         """Add a command to the handler"""
         command.context = self.context
         self.commands.append(command)
+        if not command.exact:
+            self.index.add(command)
 
     def add_rhetorical_command(
         self,
@@ -261,8 +405,7 @@ class CommandHandler:
         question_target: str | None = None,
     ) -> None:
         """Add a rhetorical command to the handler"""
-        command.context = self.context
-        self.commands.append(command)
+        self.add_command(command)
         self.context.update_rhetorical(question_type, question_target)
 
 
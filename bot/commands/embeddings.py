@@ -1,48 +1,228 @@
 """Utility functions for handling embeddings"""
 
-import torch
-import torch.nn.functional as F
-from sentence_transformers import SentenceTransformer
+from __future__ import annotations
 
-embedding_model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+import threading
+import time
+from collections import OrderedDict
 
+from . import helpers
+from .backends import EmbeddingBackend, backend_name, create_backend
+from .store import EmbeddingStore
 
-def similarity_rankings(single, matrix, k=None):
+torch = helpers.lazy_import("torch")
+F = helpers.lazy_import("torch.nn.functional")
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Which backend runs the model: "torch" (SentenceTransformer) or "onnx"
+# (int8-quantized, through onnxruntime)
+BACKEND = "torch"
+
+# Where embeddings of static phrases are persisted between runs
+STORE_DIR = "cache/embeddings"
+
+# The model and its store are created on first use, see `get_model`
+embedding_model: EmbeddingBackend | None = None
+embedding_store: EmbeddingStore | None = None
+model_lock = threading.Lock()
+
+# Upper bound on the tensor memory held by the embedding cache, and how long
+# (in seconds) an entry stays valid; `None` never expires entries
+CACHE_BYTES = 16 * 2**20
+CACHE_TTL: float | None = None
+
+
+class EmbeddingCache:
+    """
+    LRU cache of embeddings keyed by normalized text, bounded by the bytes of
+    tensor memory it holds, with optional expiry
     """
-    Compute top-k cosine similarity between two sets of embeddings.
+
+    def __init__(self, max_bytes: int, ttl: float | None = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[torch.Tensor, float]] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> torch.Tensor | None:
+        """Get a cached embedding, marking it as recently used"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None:
+                if time.monotonic() - entry[1] > self.ttl:
+                    self.remove(key)
+                    self.evictions += 1
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, embedding: torch.Tensor) -> None:
+        """Cache an embedding, evicting the least recently used to make room"""
+        size = embedding.element_size() * embedding.nelement()
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (embedding, time.monotonic())
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop every entry"""
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def remove(self, key: str) -> None:
+        """Drop an entry (internal use only, caller holds the lock)"""
+        embedding, _ = self.entries.pop(key)
+        self.bytes -= embedding.element_size() * embedding.nelement()
+
+    def stats(self) -> dict[str, int]:
+        """Hit, miss and eviction counters and current size"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+        }
+
+
+embedding_cache = EmbeddingCache(CACHE_BYTES, CACHE_TTL)
+
+
+def get_model() -> EmbeddingBackend:
+    """Get the embedding model, loading it on first use"""
+    global embedding_model
+    if embedding_model is None:
+        with model_lock:
+            if embedding_model is None:
+                embedding_model = create_backend(BACKEND, MODEL_NAME)
+    return embedding_model
+
+
+def get_store() -> EmbeddingStore:
+    """Get the on-disk embedding store of the current model"""
+    global embedding_store
+    if embedding_store is None:
+        with model_lock:
+            if embedding_store is None:
+                # keyed like the backend's name, without loading the model
+                name = backend_name(BACKEND, MODEL_NAME)
+                embedding_store = EmbeddingStore(STORE_DIR, name)
+    return embedding_store
+
+
+def set_threads(count: int) -> None:
+    """Limit the threads torch may use within a single inference"""
+    torch.set_num_threads(count)
+
+
+def use_backend(kind: str) -> None:
+    """
+    Switch the backend that computes embeddings (see `BACKEND`). Cached
+    vectors from the previous backend are dropped, and the new model is
+    loaded on first use.
+    """
+    global BACKEND, embedding_model, embedding_store
+    with model_lock:
+        BACKEND = kind
+        embedding_model = None
+        embedding_store = None
+    embedding_cache.clear()
+
+
+def normalize(matrix: torch.Tensor) -> torch.Tensor:
+    """L2-normalize the rows of a matrix (or a single vector)"""
+    return F.normalize(matrix, dim=-1)
+
+
+def top_k(
+    queries: torch.Tensor,
+    matrix: torch.Tensor | list[torch.Tensor],
+    k: int = 1,
+    normalized: bool = False,
+    chunk_rows: int = 2**18,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compute the top-k cosine similarities of a batch of queries against a
+    matrix of embeddings.
 
     Args:
-    - `single` (`numpy.ndarray`): A single vector containing the embedding to
-      compare.
-    - `matrix` (`torch.Tensor`): Tensor containing the set of embeddings to
-      compare.
-    - `k` (`int`, optional): Number of top similarities to retrieve. If None, all
-      similarities are returned.
+    - `queries` (`torch.Tensor`): An (n × d) matrix of query embeddings, or a
+      single (d) embedding.
+    - `matrix` (`torch.Tensor | list[torch.Tensor]`): An (m × d) matrix of
+      embeddings to search, or a list of blocks of rows searched as if they
+      were stacked, without copying them into one matrix.
+    - `k` (`int`): Number of top similarities to retrieve (at most m).
+    - `normalized` (`bool`): Whether the rows of `matrix` are already
+      L2-normalized, so they don't need to be normalized on every call.
+    - `chunk_rows` (`int`): Rows of `matrix` scored at a time, bounding the
+      memory of the (n × rows) score matrix for large m.
 
     Returns:
-    - `list[torch.Tensor], list[torch.Tensor]`: Tensors where each row
-      corresponds to an embedding in single, and contains the indices of the
-      top-k most similar embeddings in matrix, and tensors with cosine
-      similarities corresponding to the indices.
+    - `torch.Tensor, torch.Tensor`: (n × k) cosine similarities in
+      descending order, and the (n × k) indices of the matching rows of
+      `matrix`. A single query gives (k) tensors instead.
     """
-    single = single.unsqueeze(0)
+    blocks = [matrix] if isinstance(matrix, torch.Tensor) else matrix
+    single = queries.dim() == 1
+    queries = normalize(queries.unsqueeze(0) if single else queries)
 
-    assert single.size(-1) == matrix.size(-1), (
-        f"Dimensions of single ({single.size(-1)}) and matrix "
-        + f"({matrix.size(-1)}) do not match."
+    assert len(blocks) > 0 and queries.size(-1) == blocks[0].size(-1), (
+        f"Dimensions of queries ({queries.size(-1)}) and matrix "
+        + f"({blocks[0].size(-1) if blocks else None}) do not match."
     )
+    k = min(k, sum(block.size(0) for block in blocks))
 
-    cosine_similarity_matrix = F.cosine_similarity(
-        single.unsqueeze(1), matrix.unsqueeze(0), dim=2
-    )
+    scores = indices = None
+    pending, pending_rows, offset = [], 0, 0
 
-    rankings = list(
-        torch.argsort(cosine_similarity_matrix, dim=1, descending=True).squeeze(0)
-    )
-    rankings = rankings[:k] if k else rankings
-    cosines = [cosine_similarity_matrix.squeeze(0)[i] for i in rankings]
+    def merge():
+        # one top-k over the pending scores, merged with the best so far
+        nonlocal scores, indices, pending, pending_rows
+        chunk_scores, chunk_indices = torch.topk(
+            torch.cat(pending, dim=1), min(k, pending_rows), dim=1
+        )
+        # pending rows are consecutive rows of the stacked matrix
+        chunk_indices += offset - pending_rows
+        if scores is not None:
+            chunk_scores = torch.cat([scores, chunk_scores], dim=1)
+            chunk_indices = torch.cat([indices, chunk_indices], dim=1)
+            chunk_scores, best = torch.topk(chunk_scores, k, dim=1)
+            chunk_indices = torch.gather(chunk_indices, 1, best)
+        scores, indices = chunk_scores, chunk_indices
+        pending, pending_rows = [], 0
 
-    return rankings, cosines
+    # small blocks are scored separately but ranked together
+    for block in blocks:
+        for start in range(0, block.size(0), chunk_rows):
+            chunk = block[start : start + chunk_rows]
+            if not normalized:
+                chunk = normalize(chunk)
+            pending.append(queries @ chunk.T)
+            pending_rows += chunk.size(0)
+            offset += chunk.size(0)
+            if pending_rows >= chunk_rows:
+                merge()
+    if pending_rows:
+        merge()
+
+    assert scores is not None and indices is not None, "matrix must not be empty"
+    return (scores[0], indices[0]) if single else (scores, indices)
 
 
 def embed(text: str) -> torch.Tensor:
@@ -53,29 +233,82 @@ def embed(text: str) -> torch.Tensor:
     Returns:
     - `torch.Tensor`: A tensor containing the embedding of the given text.
     """
-    return torch.tensor(embedding_model.encode(text))
+    key = helpers.simplify(text)
+    embedding = embedding_cache.get(key)
+    if embedding is None:
+        stored = get_store().get(key)
+        if stored is not None:
+            embedding = torch.tensor(stored)
+        else:
+            embedding = torch.tensor(get_model().encode([text])[0])
+        embedding_cache.put(key, embedding)
+    return embedding
+
+
+def embed_batch(texts: list[str], persist: bool = False) -> torch.Tensor:
+    """
+    Embed several texts in a single forward pass of the model.
+    Args:
+    - `texts` (`list[str]`): The texts to embed.
+    - `persist` (`bool`): Whether to save newly computed embeddings to the
+      on-disk store, for texts that recur between runs.
+    Returns:
+    - `torch.Tensor`: A tensor whose rows are the embeddings of the texts.
+    """
+    keys = [helpers.simplify(text) for text in texts]
+    embeddings = [embedding_cache.get(key) for key in keys]
+
+    # only the texts that missed both caches go through the model
+    found: dict[str, torch.Tensor] = {}
+    missing: dict[str, str] = {}
+    for text, key, embedding in zip(texts, keys, embeddings):
+        if embedding is not None or key in found or key in missing:
+            continue
+        stored = get_store().get(key)
+        if stored is not None:
+            found[key] = torch.tensor(stored)
+        else:
+            missing[key] = text
+    if missing:
+        encoded = get_model().encode(list(missing.values()))
+        if persist:
+            get_store().add(list(missing), encoded)
+        # rows are copied so cached entries don't pin the whole batch
+        for key, row in zip(missing, encoded):
+            found[key] = torch.tensor(row)
+    if found:
+        for key, embedding in found.items():
+            embedding_cache.put(key, embedding)
+        embeddings = [
+            found[key] if embedding is None else embedding
+            for key, embedding in zip(keys, embeddings)
+        ]
+
+    return torch.stack(embeddings)
 
 
-def most_similar(query: str, queries: torch.Tensor) -> tuple[int, float]:
+def most_similar(
+    query: str | torch.Tensor, queries: torch.Tensor
+) -> tuple[int, float]:
     """
     Find the index of the most similar query to the given query, and how
     similar.
     Args:
-    - `query` (`str`): The query to compare.
+    - `query` (`str | torch.Tensor`): The query to compare, or its embedding
+      if it has already been computed.
     - `queries` (`list[str] | torch.Tensor`): A list of queries to compare
       against, or a tensor of embeddings of the queries.
     Returns:
     - `int, float`: The index of the most similar query in `queries`, and its
       similarity score.
     """
-    qemb = embed(query)
-    qembs = queries
-    result = similarity_rankings(qemb, qembs, 1)
-    return int(result[0][0]), float(result[1][0])
+    qemb = embed(query) if isinstance(query, str) else query
+    scores, indices = top_k(qemb, queries, 1)
+    return int(indices[0]), float(scores[0])
 
 
 if __name__ == "__main__":
-    # Test similarity_rankings
+    # Test top_k
     s = torch.tensor([0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8])
     m = torch.tensor(
         [
@@ -86,7 +319,7 @@ if __name__ == "__main__":
             [0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2],
         ]
     )
-    print(similarity_rankings(s, m, 3))
+    print(top_k(s, m, 3))
 
     # Test embed
     qs = [
@@ -1,8 +1,28 @@
 """Helper functions for the project"""
 
+import importlib
 import re
+from types import ModuleType
 
 
 def simplify(phrase: str) -> str:
     """Format a phrase to make it easier to compare"""
     return re.sub(r"\.|!|\?|'|,", r"", phrase.lower()).strip()
+
+
+class LazyModule:
+    """Stand-in for a module that is only imported once it is first used"""
+
+    def __init__(self, name: str):
+        self.__name = name
+        self.__module: ModuleType | None = None
+
+    def __getattr__(self, attr: str):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attr)
+
+
+def lazy_import(name: str) -> LazyModule:
+    """Import a (heavy) module on first attribute access instead of right away"""
+    return LazyModule(name)
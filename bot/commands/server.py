@@ -0,0 +1,176 @@
+"""
+Local embedding server: several bot processes share one loaded model over a
+Unix socket. Requests that arrive within a short window are run as a single
+batch.
+
+Run with `python -m bot.commands.server`.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from .backends import BACKENDS, EmbeddingBackend, create_backend
+
+SOCKET_PATH = "cache/embeddings.sock"
+
+# Seconds to wait for more requests before running a batch, and the number of
+# texts that runs a batch right away
+BATCH_WINDOW = 0.005
+MAX_BATCH = 64
+
+# Every frame is a 4-byte big-endian length followed by that many bytes. A
+# request is one frame with a JSON list of texts; a response is a JSON header
+# frame ({"shape": [rows, dim], "model": backend name} or {"error": message}),
+# followed on success by a frame of float32 vectors.
+FRAME = struct.Struct(">I")
+
+
+def frame(payload: bytes) -> bytes:
+    """Prefix a payload with its length"""
+    return FRAME.pack(len(payload)) + payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    """Read one length-prefixed frame"""
+    (size,) = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return await reader.readexactly(size)
+
+
+class EmbeddingServer:
+    """Serves embeddings, collecting concurrent requests into micro-batches"""
+
+    def __init__(
+        self,
+        backend: EmbeddingBackend,
+        window: float = BATCH_WINDOW,
+        max_batch: int = MAX_BATCH,
+    ):
+        self.backend = backend
+        self.window = window
+        self.max_batch = max_batch
+        self.pending: list[tuple[list[str], asyncio.Future]] = []
+        self.pending_texts = 0
+        self.timer: asyncio.TimerHandle | None = None
+        # one worker, so batches run one at a time while the next one fills
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batches = 0
+        self.texts = 0
+
+    async def serve(self, path: str = SOCKET_PATH) -> None:
+        """Listen on a Unix socket until cancelled"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle, path)
+        print(f"Serving {self.backend.name} embeddings on {path}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Answer the requests of one client connection"""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    texts = json.loads(await read_frame(reader))
+                    if not isinstance(texts, list) or not all(
+                        isinstance(text, str) for text in texts
+                    ):
+                        raise ValueError("expected a JSON list of texts")
+                except ValueError as e:
+                    writer.write(frame(json.dumps({"error": str(e)}).encode()))
+                    await writer.drain()
+                    continue
+                future = loop.create_future()
+                self.submit(texts, future)
+                try:
+                    vectors = await future
+                except Exception as e:  # pylint: disable=broad-except
+                    writer.write(frame(json.dumps({"error": str(e)}).encode()))
+                else:
+                    header = {"shape": list(vectors.shape), "model": self.backend.name}
+                    header = json.dumps(header).encode()
+                    writer.write(frame(header) + frame(vectors.tobytes()))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def submit(self, texts: list[str], future: asyncio.Future) -> None:
+        """Queue a request for the next batch"""
+        self.pending.append((texts, future))
+        self.pending_texts += len(texts)
+        if self.pending_texts >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(self.window, self.flush)
+
+    def flush(self) -> None:
+        """Run everything queued so far as one batch"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending, self.pending_texts = self.pending, [], 0
+        if batch:
+            asyncio.get_running_loop().create_task(self.run_batch(batch))
+
+    async def run_batch(
+        self, batch: list[tuple[list[str], asyncio.Future]]
+    ) -> None:
+        """Encode a batch off the event loop and hand each request its rows"""
+        texts = [text for request, _ in batch for text in request]
+        loop = asyncio.get_running_loop()
+        try:
+            vectors = await loop.run_in_executor(
+                self.executor, self.backend.encode, texts
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.texts += len(texts)
+        offset = 0
+        for request, future in batch:
+            if not future.done():
+                future.set_result(vectors[offset : offset + len(request)])
+            offset += len(request)
+
+
+if __name__ == "__main__":
+    from .embeddings import MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="Run the embedding server")
+    parser.add_argument("-s", type=str, default=SOCKET_PATH, help="Socket path")
+    parser.add_argument(
+        "-w", type=float, default=BATCH_WINDOW * 1e3, help="Batch window (ms)"
+    )
+    parser.add_argument("-n", type=int, default=MAX_BATCH, help="Max batch size")
+    parser.add_argument(
+        "-b",
+        type=str,
+        choices=[kind for kind in BACKENDS if kind != "remote"],
+        default="torch",
+        help="Backend",
+    )
+    args = parser.parse_args()
+
+    embedding_server = EmbeddingServer(
+        create_backend(args.b, MODEL_NAME), args.w / 1e3, args.n
+    )
+    try:
+        asyncio.run(embedding_server.serve(args.s))
+    except KeyboardInterrupt:
+        pass
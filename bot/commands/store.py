@@ -0,0 +1,130 @@
+"""Persistent on-disk store of embeddings"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+from .helpers import lazy_import
+
+np = lazy_import("numpy")
+
+# Bumped whenever the on-disk layout changes; each version has its own folder
+FORMAT_VERSION = 1
+
+# Segments are merged into one once there are more than this many
+MAX_SEGMENTS = 32
+
+
+def text_hash(text: str) -> str:
+    """Stable hash of a text, used as its key in the store"""
+    return hashlib.sha1(text.encode("UTF-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Append-only store of the embeddings of one model. Vectors live in
+    immutable segments: a `.npy` matrix that is memory-mapped read-only, and
+    a `.json` list of the text hashes of its rows. Segments are written under
+    a temporary name and renamed into place (matrix first, keys last), so any
+    number of processes can read the store, sharing the mapped pages, while
+    another one adds to it.
+    """
+
+    def __init__(self, root: str, model_name: str):
+        slug = model_name.replace("/", "--")
+        self.path = os.path.join(root, slug, f"v{FORMAT_VERSION}")
+        self.segments: dict[str, np.ndarray] = {}
+        self.rows: dict[str, tuple[str, int]] = {}
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def refresh(self) -> None:
+        """Map the segments written since the store was last read"""
+        if not os.path.isdir(self.path):
+            return
+        with self.lock:
+            for name in sorted(os.listdir(self.path)):
+                segment, ext = os.path.splitext(name)
+                if ext != ".json" or segment in self.segments:
+                    continue
+                try:
+                    with open(os.path.join(self.path, name), encoding="UTF-8") as f:
+                        hashes = json.load(f)
+                    vectors = np.load(
+                        os.path.join(self.path, segment + ".npy"), mmap_mode="r"
+                    )
+                except FileNotFoundError:
+                    continue  # removed by a concurrent compaction
+                self.segments[segment] = vectors
+                for row, key in enumerate(hashes):
+                    self.rows.setdefault(key, (segment, row))
+
+    def get(self, text: str) -> np.ndarray | None:
+        """Get the stored embedding of a text (read-only), if there is one"""
+        key = text_hash(text)
+        # `compact` replaces rows and segments, possibly on another thread
+        with self.lock:
+            location = self.rows.get(key)
+            if location is None:
+                return None
+            segment, row = location
+            return self.segments[segment][row]
+
+    def add(self, texts: list[str], vectors: np.ndarray) -> None:
+        """Persist the embeddings of texts that aren't stored yet"""
+        keys = [text_hash(text) for text in texts]
+        with self.lock:
+            new = [i for i, key in enumerate(keys) if key not in self.rows]
+            if not new:
+                return
+            self.write([keys[i] for i in new], np.asarray(vectors)[new])
+            if len(self.segments) > MAX_SEGMENTS:
+                self.compact()
+
+    def write(self, keys: list[str], vectors: np.ndarray) -> str:
+        """
+        Atomically write a new segment and map it (internal use only, caller
+        holds the lock)
+        """
+        os.makedirs(self.path, exist_ok=True)
+        segment = uuid.uuid4().hex
+        base = os.path.join(self.path, segment)
+
+        with open(base + ".npy.tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+        os.replace(base + ".npy.tmp", base + ".npy")
+        with open(base + ".json.tmp", "w", encoding="UTF-8") as f:
+            json.dump(keys, f)
+        os.replace(base + ".json.tmp", base + ".json")
+
+        self.segments[segment] = np.load(base + ".npy", mmap_mode="r")
+        for row, key in enumerate(keys):
+            self.rows.setdefault(key, (segment, row))
+        return segment
+
+    def compact(self) -> None:
+        """
+        Merge all segments into one and remove the old files (caller holds
+        the lock)
+        """
+        old = list(self.segments)
+        keys = list(self.rows)
+        vectors = np.stack([self.segments[s][r] for s, r in self.rows.values()])
+        self.rows = {}
+        merged = self.write(keys, vectors)
+
+        for segment in old:
+            del self.segments[segment]
+            for ext in (".json", ".npy"):
+                try:
+                    os.remove(os.path.join(self.path, segment + ext))
+                except FileNotFoundError:
+                    pass
+        assert merged in self.segments
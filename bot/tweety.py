@@ -1,14 +1,23 @@
 """Contains Tweety Bot class for IRC"""
 
+import asyncio
 import random
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
+from bot.commands import embeddings as em
 from bot.commands import helpers
 from irc.irc import IRC
 from irc.message import Message
-from music.music import MusicHandler, SongInfo
+from music.music import MusicHandler, SongInfo, Stanza
 
 from .commands.commands import Command, CommandHandler
 
+# Threads that run model inference off the connection loop, and the threads
+# torch may use within one inference (`None` keeps torch's default)
+INFERENCE_WORKERS = 2
+TORCH_THREADS: int | None = None
+
 
 def oxford(items: list[str]) -> str:
     """
@@ -115,27 +124,53 @@ class PersonMemory:
         self.confusions += 1
 
 
-class TweetyBot:
-    """Tweety Bot class for IRC"""
-
-    def __init__(self, channel: str | None = None):
-        self.irc = IRC(channel)
-        self.ch = CommandHandler()
-        self.mh = MusicHandler()
+class Conversation:
+    """Conversation state of a single channel"""
 
+    def __init__(self, channel: str, ch: CommandHandler):
+        self.channel = channel
+        self.ch = ch
         self.interactions: dict[str, PersonMemory] = {}
+        # messages of a channel are handled one at a time, in order
+        self.lock = asyncio.Lock()
+
 
-        self.ch.add_command(
+class TweetyBot:
+    """Tweety Bot class for IRC"""
+
+    def __init__(
+        self,
+        channels: str | list[str] | None = None,
+        workers: int = INFERENCE_WORKERS,
+        torch_threads: int | None = TORCH_THREADS,
+        semantic: bool = False,
+        channel: str | None = None,
+    ):
+        self.irc = IRC(channels or channel)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.tasks: set[asyncio.Task] = set()
+        if torch_threads is not None:
+            em.set_threads(torch_threads)
+        self.mh = MusicHandler(semantic=semantic)
+        self.mh.load()
+
+        # commands are built (and their phrases embedded) once, then forked
+        # for each channel's conversation
+        self.base_ch = CommandHandler()
+        self.conversations: dict[str, Conversation] = {}
+        self.conv: Conversation | None = None
+
+        self.base_ch.add_command(
             Command(  # Hello
                 phrases=["hello", "hi", "hey", "whats up"], callback=self.hello
             )
         )
 
-        self.ch.add_command(
+        self.base_ch.add_command(
             Command(phrases=["forget"], callback=self.forget, exact=True)  # Forget
         )
 
-        self.ch.add_command(  # Purpose
+        self.base_ch.add_command(  # Purpose
             Command(
                 phrases=[
                     "purpose",
@@ -148,7 +183,7 @@ class TweetyBot:
             )
         )
 
-        self.ch.add_command(  # Remember
+        self.base_ch.add_command(  # Remember
             Command(
                 phrases=[
                     "remember me",
@@ -161,7 +196,7 @@ class TweetyBot:
             )
         )
 
-        self.ch.add_command(
+        self.base_ch.add_command(
             Command(  # Title of song
                 phrases=[
                     "song name",
@@ -173,7 +208,7 @@ class TweetyBot:
             )
         )
 
-        self.ch.add_command(
+        self.base_ch.add_command(
             Command(  # Artist of song
                 phrases=[
                     "song artist",
@@ -186,7 +221,7 @@ class TweetyBot:
             )
         )
 
-        self.ch.add_command(
+        self.base_ch.add_command(
             Command(  # Year of song
                 phrases=[
                     "song year",
@@ -201,7 +236,7 @@ class TweetyBot:
             )
         )
 
-        self.ch.add_command(
+        self.base_ch.add_command(
             Command(  # Genre of song
                 phrases=[
                     "song genre",
@@ -213,7 +248,7 @@ class TweetyBot:
         )
 
         for question_type in SongInfo:
-            self.ch.add_command(
+            self.base_ch.add_command(
                 Command(
                     phrases=[],
                     callback=self.rhetorical,
@@ -221,68 +256,145 @@ class TweetyBot:
                 )
             )
 
-        self.ch.add_command(
+        self.base_ch.add_command(
             Command(phrases=["die"], callback=self.die, exact=True)  # Die
         )
 
+        # embed every command phrase in one batch
+        self.base_ch.embed_pending()
+
     def start(self):
         """Start the bot"""
-        self.irc.connect()
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            pass
+
+    async def run(self):
+        """Connect and process messages as they arrive"""
+        await self.irc.connect_async()
 
         try:
-            for message in self.irc.messages():
-                self.ch.new_message(message)
-                assert message.sender is not None
-
-                if message.is_for_bot():
-                    command = self.ch.closest_command(threshold=0.2, min_diff=0.005)
-
-                    if command is not None:
-                        print(
-                            f"\n[Matched phrase: {command.get_last_matched_phrase()}]\n"
-                        )
-                        response = command.run(command)
-                        assert isinstance(response, Message)
-                        self.irc.send(response)
-
-                    else:
-                        print("\n[No matching command for message]\n")
-                        response = Message(
-                            target=message.sender,
-                            content="i don't understand what you're saying... >.<",
-                        )
-                        self.irc.send(response)
-                else:
-                    stanza = self.mh.next_stanza(message)
-                    if stanza is not None:
-                        print("\n[Matched a stanza]\n")
-                        rhetorical_type = random.choice(list(SongInfo))
+            async for message in self.irc.messages():
+                # channels are handled concurrently, so a slow inference in
+                # one never holds up the connection or the other channels
+                task = asyncio.create_task(self.handle(message))
+                self.tasks.add(task)
+                task.add_done_callback(self.handled)
+
+        except asyncio.CancelledError:
+            for conv in self.conversations.values():
+                self.irc.send(
+                    Message(content="i have been terminated X.X", channel=conv.channel)
+                )
+            await self.irc.drain()
+            self.irc.disconnect()
+            raise
+
+    @property
+    def ch(self) -> CommandHandler:
+        """Command handler of the conversation being handled"""
+        assert self.conv is not None
+        return self.conv.ch
+
+    @property
+    def interactions(self) -> dict[str, PersonMemory]:
+        """Memories of the people in the conversation being handled"""
+        assert self.conv is not None
+        return self.conv.interactions
+
+    def conversation(self, channel: str) -> Conversation:
+        """Get the conversation state of a channel"""
+        key = channel.lower()
+        if key not in self.conversations:
+            self.conversations[key] = Conversation(channel, self.base_ch.fork())
+        return self.conversations[key]
+
+    def reply(self, message: Message) -> None:
+        """Send a message back to the channel being handled"""
+        assert self.conv is not None
+        if message.channel is None:
+            message.channel = self.conv.channel
+        self.irc.send(message)
+
+    def handled(self, task: asyncio.Task) -> None:
+        """Report a message handler that failed (internal use only)"""
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print("\n[Error handling message]")
+            traceback.print_exception(task.exception())
+
+    async def infer(self, fn, *args, **kwargs):
+        """Run model inference on the executor, off the connection loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    def find_stanza(
+        self, conv: Conversation, message: Message
+    ) -> tuple[Stanza | None, SongInfo, bool]:
+        """
+        Look for a stanza matching a message and, if one is found, switch the
+        conversation to it (runs on the executor)
+        """
+        stanza = self.mh.next_stanza(message, conv.ch.context)
+        rhetorical_type = random.choice(list(SongInfo))
+
+        # likelihood to ask rhetorical
+        ask_rhetorical = random.random() <= 0.5
+
+        if stanza is not None:
+            conv.ch.new_stanza(stanza, rhetorical_type if ask_rhetorical else None)
+        return stanza, rhetorical_type, ask_rhetorical
+
+    async def handle(self, message: Message):
+        """Respond to a single channel message"""
+        assert message.channel is not None
+        assert message.sender is not None
+        conv = self.conversation(message.channel)
+
+        async with conv.lock:
+            conv.ch.new_message(message)
+
+            if message.is_for_bot():
+                command = await self.infer(
+                    conv.ch.closest_command, threshold=0.2, min_diff=0.005
+                )
+                # callbacks act on the conversation being handled; nothing
+                # below awaits, so no other channel can interleave
+                self.conv = conv
 
-                        # likelihood to ask rhetorical
-                        ask_rhetorical = random.random() <= 0.5
+                if command is not None:
+                    print(f"\n[Matched phrase: {command.get_last_matched_phrase()}]\n")
+                    response = command.run(command)
+                    assert isinstance(response, Message)
+                    self.reply(response)
 
-                        self.ch.new_stanza(
-                            stanza, rhetorical_type if ask_rhetorical else None
-                        )
+                else:
+                    print("\n[No matching command for message]\n")
+                    response = Message(
+                        target=message.sender,
+                        content="i don't understand what you're saying... >.<",
+                    )
+                    self.reply(response)
+            else:
+                stanza, rhetorical_type, ask_rhetorical = await self.infer(
+                    self.find_stanza, conv, message
+                )
+                self.conv = conv
 
-                        self.irc.send(
-                            Message(target=message.sender, content=f'"{stanza.stanza}"')
-                        )
+                if stanza is not None:
+                    print("\n[Matched a stanza]\n")
 
-                        if ask_rhetorical:
-                            self.person(message.sender).remember_ask(
-                                f'"{stanza.title}"'
-                            )
-                            print(f"[Asking {message.sender} a rhetorical]\n")
+                    self.reply(
+                        Message(target=message.sender, content=f'"{stanza.stanza}"')
+                    )
 
-                            response = self.add_rhetorical(
-                                message.sender, rhetorical_type
-                            )
-                            self.irc.send(response)
+                    if ask_rhetorical:
+                        self.person(message.sender).remember_ask(f'"{stanza.title}"')
+                        print(f"[Asking {message.sender} a rhetorical]\n")
 
-        except KeyboardInterrupt:
-            self.irc.send(Message(content="i have been terminated X.X"))
-            self.irc.disconnect()
+                        response = self.add_rhetorical(message.sender, rhetorical_type)
+                        self.reply(response)
 
     def person(self, sender: str) -> PersonMemory:
         """Get the memory of a person"""
@@ -292,7 +404,7 @@ class TweetyBot:
 
     def add_rhetorical(self, sender: str, rhetorical_type: SongInfo) -> Message:
         """Ask a rhetorical question"""
-        stanza = self.mh.cur_stanza
+        stanza = self.ch.context.cur_stanza
         assert stanza is not None
 
         questions = {
@@ -316,10 +428,10 @@ class TweetyBot:
         latest_message = context.latest_message
         assert latest_message is not None and latest_message.sender is not None
         assert (
-            self.mh.cur_stanza is not None
+            self.ch.context.cur_stanza is not None
         ), "There should be a stanza... something is broken"
         assert latest_message.content is not None
-        cur_stanza = self.mh.cur_stanza
+        cur_stanza = self.ch.context.cur_stanza
         answers: dict[SongInfo, tuple[str, str]] = {
             SongInfo.SONG_TITLE: (cur_stanza.title, f"'s called {cur_stanza.title}"),
             SongInfo.SONG_ARTIST: (cur_stanza.artist, f"'s by {cur_stanza.artist}"),
@@ -396,8 +508,7 @@ class TweetyBot:
         assert latest_message is not None
 
         self.ch.reset()
-        self.mh.forget()
-        self.interactions = {}
+        self.interactions.clear()
 
         print("[Forgot everything]\n")
 
@@ -447,7 +558,7 @@ class TweetyBot:
         """Song name command"""
         context = self.ch.context
         latest_message = context.latest_message
-        cur_stanza = self.mh.cur_stanza
+        cur_stanza = self.ch.context.cur_stanza
 
         assert latest_message is not None and latest_message.sender is not None
 
@@ -489,7 +600,7 @@ class TweetyBot:
         """Song artist command"""
         context = self.ch.context
         latest_message = context.latest_message
-        cur_stanza = self.mh.cur_stanza
+        cur_stanza = self.ch.context.cur_stanza
 
         assert latest_message is not None and latest_message.sender is not None
 
@@ -531,7 +642,7 @@ class TweetyBot:
         """Song year command"""
         context = self.ch.context
         latest_message = context.latest_message
-        cur_stanza = self.mh.cur_stanza
+        cur_stanza = self.ch.context.cur_stanza
 
         assert latest_message is not None and latest_message.sender is not None
 
@@ -573,7 +684,7 @@ class TweetyBot:
         """Song genre command"""
         context = self.ch.context
         latest_message = context.latest_message
-        cur_stanza = self.mh.cur_stanza
+        cur_stanza = self.ch.context.cur_stanza
 
         assert latest_message is not None and latest_message.sender is not None
 
@@ -619,5 +730,5 @@ class TweetyBot:
         return Message(
             target=latest_message.sender,
             content="aww okay, goodbye... X.X",
-            cb=self.irc.disconnect(),
+            cb=self.irc.disconnect,
         )
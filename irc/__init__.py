@@ -2,3 +2,4 @@
 
 from .irc import IRC
 from .message import Message
+from .stream import LineBuffer
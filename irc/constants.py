@@ -1,11 +1,36 @@
 """Constants for IRC"""
 
-CHANNEL = "#CSC582"
+CHANNELS = ["#CSC582"]
+# The first channel, for code written when the bot served a single one
+CHANNEL = CHANNELS[0]
+JOINED = frozenset(channel.lower() for channel in CHANNELS)
 SERVER = "irc.libera.chat"
 PORT = 6667
 NICKNAME = "Tweety-bot"
 
+# Longest channel list sent in a single JOIN
+JOIN_LENGTH = 400
+
+# Bytes requested from the socket per read
+RECV_SIZE = 4096
+
+# Seconds to wait for the server's welcome (001) before joining anyway
+REGISTER_TIMEOUT = 5
+# Outbound flood control: messages sent back to back, then messages per second
+FLOOD_BURST = 4
+FLOOD_RATE = 0.5
+
+# Range of seconds a reply "types" for before it is queued for sending
+REPLY_DELAY = (1, 3)
+
+def update_channels(channels: str | list[str]) -> None:
+    """Update the channels, given as a list or a single channel name"""
+    global CHANNELS, CHANNEL, JOINED
+    CHANNELS = [channels] if isinstance(channels, str) else list(channels)
+    CHANNEL = CHANNELS[0] if CHANNELS else CHANNEL
+    JOINED = frozenset(channel.lower() for channel in CHANNELS)
+
+
 def update_channel(channel: str) -> None:
-    """Update the channel"""
-    global CHANNEL
-    CHANNEL = channel
+    """Update the channel (a single one, see `update_channels`)"""
+    update_channels([channel])
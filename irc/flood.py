@@ -0,0 +1,32 @@
+"""Flood control for outbound IRC messages"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: up to `burst` messages go out back to back,
+    after which sending is limited to `rate` messages per second
+    """
+
+    def __init__(self, burst: int, rate: float):
+        assert burst >= 1 and rate > 0, "TokenBucket Error: invalid burst or rate"
+        self.burst = burst
+        self.rate = rate
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def refill(self) -> None:
+        """Add the tokens accumulated since the last refill"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    async def acquire(self) -> None:
+        """Wait until a token is available, then take it"""
+        self.refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.refill()
+        self.tokens -= 1
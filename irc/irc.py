@@ -1,102 +1,314 @@
 """Contains IRC class for the bot"""
 
+import asyncio
 import random
-import re
-import socket
-import time
+import traceback
+from typing import Callable
 
 from irc import constants as c
+from .flood import TokenBucket
 from .message import Message
+from .stream import LineBuffer
+
+
+class MessageStream:
+    """
+    Stream of incoming channel messages, usable with both `async for` and a
+    plain `for` loop (the latter drives the event loop for the caller)
+    """
+
+    def __init__(self, irc: "IRC"):
+        self.irc = irc
+
+    def __aiter__(self) -> "MessageStream":
+        return self
+
+    async def __anext__(self) -> Message:
+        message = await self.irc.next_message()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def __iter__(self) -> "MessageStream":
+        return self
+
+    def __next__(self) -> Message:
+        message = self.irc.run(self.irc.next_message())
+        if message is None:
+            raise StopIteration
+        return message
 
 
 class IRC:
     """IRC class for the bot"""
 
-    irc = socket.socket()
-
-    def __init__(self, channel: str | None = None):
-        """Initialize the IRC socket"""
-        if channel:
-            c.update_channel(channel)
-        print("Initializing IRC socket...")
-        self.irc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def __init__(
+        self,
+        channels: str | list[str] | None = None,
+        burst: int = c.FLOOD_BURST,
+        rate: float = c.FLOOD_RATE,
+        channel: str | None = None,
+    ):
+        """
+        Initialize the IRC connection state; `channels` may be a single
+        channel name, and `channel` is its older name
+        """
+        channels = channels or channel
+        if channels:
+            c.update_channels(channels)
+        print("Initializing IRC connection...")
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.inbox: asyncio.Queue[Message | None] = asyncio.Queue()
+        # Replies of each channel are typed one after another in their own
+        # queue, so channels don't wait on each other's typing delays; only
+        # the flood limits are shared by the whole connection
+        self.outboxes: dict[str, asyncio.Queue[tuple[float, str, Callable | None]]] = {}
+        self.senders: dict[str, asyncio.Task] = {}
+        self.next_due: dict[str, float] = {}
+        self.bucket = TokenBucket(burst, rate)
+        self.registered = asyncio.Event()
+        self.receiver: asyncio.Task | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
         self.open = False
 
+    def run(self, coro):
+        """Drive a coroutine to completion for synchronous callers"""
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(coro)
+
     def command(self, msg: str):
         """Send a command to the server"""
         if msg != "QUIT":
             print(f"  > {msg}")
-        self.irc.send(bytes(msg + "\n", "UTF-8"))
+        assert self.writer is not None, "IRC Error: not connected"
+        self.writer.write(bytes(msg + "\r\n", "UTF-8"))
 
     def send(self, message: Message):
-        """Send a message to the channel"""
+        """
+        Queue a message for its channel (the first joined channel if it has
+        none) without blocking. It goes out after a
+        human-like typing delay (in order with earlier replies to the same
+        channel) and within the flood limits; `message.cb` runs once it has
+        actually been written.
+        """
         if self.open:
-            time.sleep(random.randint(1, 3))
-            self.command(f"PRIVMSG {c.CHANNEL} :{message.assemble()}")
-            if message.cb:
-                time.sleep(1)
-                message.cb()
+            assert self.loop is not None
+            channel = message.channel or c.CHANNELS[0]
+            now = self.loop.time()
+            due = max(now, self.next_due.get(channel, 0.0))
+            due += random.uniform(*c.REPLY_DELAY)
+            self.next_due[channel] = due
+            line = f"PRIVMSG {channel} :{message.assemble()}"
+            self.outbox(channel).put_nowait((due, line, message.cb))
 
-    def connect(self):
+    def outbox(self, channel: str) -> asyncio.Queue:
+        """
+        Reply queue of `channel`, whose sender is started on first use and
+        restarted if it stopped (internal use only)
+        """
+        if channel not in self.outboxes:
+            self.outboxes[channel] = asyncio.Queue()
+        sender = self.senders.get(channel)
+        if self.open and (sender is None or sender.done()):
+            assert self.loop is not None
+            self.senders[channel] = self.loop.create_task(
+                self.flush(self.outboxes[channel])
+            )
+        return self.outboxes[channel]
+
+    async def flush(self, outbox: asyncio.Queue):
+        """Write queued messages as their delays and tokens allow (internal use only)"""
+        assert self.loop is not None
+        while self.open:
+            due, line, cb = await outbox.get()
+            try:
+                await asyncio.sleep(max(0.0, due - self.loop.time()))
+                await self.bucket.acquire()
+                if self.open:
+                    self.command(line)
+                    if cb:
+                        cb()
+            except Exception:  # pylint: disable=broad-except
+                # a failed reply mustn't stop the replies queued after it
+                print("\n[Error sending reply]")
+                traceback.print_exc()
+            finally:
+                outbox.task_done()
+
+    async def drain(self):
+        """Wait until every queued message has been written"""
+        if self.open:
+            await asyncio.gather(
+                *(
+                    outbox.join()
+                    for channel, outbox in self.outboxes.items()
+                    if channel in self.senders and not self.senders[channel].done()
+                )
+            )
+
+    async def connect_async(self):
         """Connect to the server"""
-        print(f'Connecting to "{c.CHANNEL}" through "{c.SERVER}:{c.PORT}"...')
-        self.irc.connect((c.SERVER, c.PORT))
+        print(f'Connecting to {", ".join(c.CHANNELS)} through "{c.SERVER}:{c.PORT}"...')
+        self.reader, self.writer = await asyncio.open_connection(c.SERVER, c.PORT)
+        self.loop = asyncio.get_running_loop()
         self.open = True
         print("Connected\n")
 
+        # PINGs are answered by the receiver task, independent of the consumer,
+        # and replies are written by a sender task per channel, independent of both
+        self.receiver = asyncio.create_task(self.receive())
+
         # Perform user authentication
         self.command("USER " + c.NICKNAME + " " + c.NICKNAME + " " + c.NICKNAME + " :python")
         self.command("NICK " + c.NICKNAME)
-        time.sleep(5)
+        try:
+            await asyncio.wait_for(self.registered.wait(), c.REGISTER_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
 
-        # join the channel
-        self.command("JOIN " + c.CHANNEL)
+        # join the channels, several per JOIN within the line length limit
+        batch: list[str] = []
+        for channel in c.CHANNELS:
+            if batch and len(",".join(batch + [channel])) > c.JOIN_LENGTH:
+                self.command("JOIN " + ",".join(batch))
+                batch = []
+            batch.append(channel)
+        if batch:
+            self.command("JOIN " + ",".join(batch))
+
+    def connect(self):
+        """Connect to the server (synchronous wrapper)"""
+        self.run(self.connect_async())
 
     def disconnect(self):
         """Disconnect from the server"""
         print("\nDisconnecting...")
-        self.command("QUIT")
+        if self.writer is not None and not self.writer.is_closing():
+            self.command("QUIT")
+            self.writer.close()
         self.open = False
+        for sender in self.senders.values():
+            sender.cancel()
         print("Disconnected")
 
-    def get_response(self) -> list[Message]:
-        """Get the response from the server"""
-        time.sleep(1)
-        resp = self.irc.recv(2040).decode("UTF-8").lstrip()
-        raw_messages = re.findall(r"(:.*?)(?=:\n|$)", resp, re.DOTALL | re.MULTILINE)
-        split_messages = [m.replace("\n", "") for m in raw_messages]
-        messages = [Message(m) for m in split_messages if m]
+    async def receive(self):
+        """Read lines from the server until it hangs up (internal use only)"""
+        assert self.reader is not None
+        lines = LineBuffer()
+        try:
+            while self.open:
+                chunk = await self.reader.read(c.RECV_SIZE)
+                if not chunk:
+                    break
+                for line in lines.feed(chunk):
+                    if not self.dispatch(line.decode("UTF-8", errors="replace")):
+                        return
+        finally:
+            self.open = False
+            self.inbox.put_nowait(None)
 
-        if resp.find("PING") != -1:
-            self.command("PONG " + resp.split()[1] + "\r")
+    def dispatch(self, raw_message: str) -> bool:
+        """
+        Handle one complete line from the server (internal use only).
+        Returns `False` if the server reported an error.
+        """
+        message = Message(raw_message)
+        if message.command == "PING":
+            self.command("PONG :" + message.params[-1] if message.params else "PONG")
+            return True
 
-        error_queue = []
+        if message.error:
+            print(f"  < {message.raw_message}")
+            print("\nError:", message.error)
+            print("Disconnected")
+            return False
+
+        if message.command == "001":
+            self.registered.set()
 
-        for message in messages:
-            if message.error:
-                error_queue.append(message.error)
-                self.open = False
+        self.inbox.put_nowait(message)
+        return True
 
-        if len(error_queue) > 0:
-            for message in messages:
+    async def next_message(self) -> Message | None:
+        """
+        Wait for the next message in the channel, or `None` once the
+        connection is closed
+        """
+        while True:
+            message = await self.inbox.get()
+            if message is None or not self.open:
+                return None
+            if message.is_for_bot():
+                print(f"* < {message.raw_message}")
+                return message
+            if message.is_priv():
                 print(f"  < {message.raw_message}")
-            print("\nError:", "\n       ".join(error_queue))
-            print("Disconnected")
-            return []
+                return message
+            print(f"  $ {message.raw_message}")
 
+    async def get_response_async(self) -> list[Message]:
+        """Wait for at least one message and return everything received"""
+        messages = []
+        message = await self.inbox.get()
+        while message is not None:
+            messages.append(message)
+            if self.inbox.empty():
+                break
+            message = self.inbox.get_nowait()
         return messages
 
-    def messages(self):
+    def get_response(self) -> list[Message]:
+        """Get the response from the server (synchronous wrapper)"""
+        return self.run(self.get_response_async())
+
+    def messages(self) -> MessageStream:
         """Get messages from the server"""
-        while self.open:
-            for message in self.get_response():
-                if not self.open:
-                    break
-                if message.is_for_bot():
-                    print(f"* < {message.raw_message}")
-                    yield message
-                elif message.is_priv():
-                    print(f"  < {message.raw_message}")
-                    yield message
-                else:
-                    print(f"  $ {message.raw_message}")
+        return MessageStream(self)
+
+
+if __name__ == "__main__":
+    # Run the client against a local stand-in IRC server
+
+    async def stand_in(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Minimal server: welcome, PING, then a few channel lines"""
+        while not (await reader.readline()).startswith(b"NICK"):
+            pass
+        writer.write(b":stand.in 001 " + c.NICKNAME.encode() + b" :Welcome\r\n")
+        assert (await reader.readline()).startswith(b"JOIN")
+        writer.write(b"PING :stand.in\r\n")
+        assert (await reader.readline()).strip() == b"PONG :stand.in"
+        for line in [
+            ":alice!a@host PRIVMSG #CSC582 :never an honest word",
+            f":alice!a@host PRIVMSG #music :{c.NICKNAME}: hello",
+            ":alice!a@host PRIVMSG #elsewhere :not for us",
+        ]:
+            writer.write(line.encode() + b"\r\n")
+        await writer.drain()
+        reply = (await reader.readline()).strip()
+        assert reply == b"PRIVMSG #music :alice: hey :)", reply
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(stand_in, "127.0.0.1", 0)
+        c.SERVER, c.PORT = "127.0.0.1", server.sockets[0].getsockname()[1]
+        c.REPLY_DELAY = (0, 0)
+        irc = IRC(["#CSC582", "#music"])
+        await irc.connect_async()
+        flushed = []
+        received = []
+        async for message in irc.messages():
+            received.append(message)
+            if message.is_for_bot():
+                reply = Message(
+                    target=message.sender, content="hey :)", channel=message.channel
+                )
+                reply.cb = lambda: flushed.append(reply)
+                irc.send(reply)
+        server.close()
+        assert [m.content for m in received] == ["never an honest word", "hello"]
+        assert len(flushed) == 1
+        print("\nStand-in server test passed")
+
+    asyncio.run(main())
@@ -1,67 +1,138 @@
 """Contains message class for IRC messages"""
 
-import re
 from typing import Callable
 
 from irc import constants as c
 
+TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+
+def unescape_tag_value(value: str) -> str:
+    """Unescape an IRCv3 message tag value"""
+    if "\\" not in value:
+        return value
+    out = []
+    chars = iter(value)
+    for char in chars:
+        if char == "\\":
+            escaped = next(chars, "")
+            out.append(TAG_ESCAPES.get(escaped, escaped))
+        else:
+            out.append(char)
+    return "".join(out)
+
+
+def parse_tags(tags: str) -> dict[str, str]:
+    """Parse the IRCv3 tag section of a line (without the leading `@`)"""
+    parsed = {}
+    for tag in tags.split(";"):
+        if tag:
+            key, _, value = tag.partition("=")
+            parsed[key] = unescape_tag_value(value)
+    return parsed
+
 
 class Message:
     """Message class for IRC messages"""
 
+    __slots__ = (
+        "raw_message",
+        "tags",
+        "prefix",
+        "sender",
+        "command",
+        "params",
+        "channel",
+        "target",
+        "content",
+        "error",
+        "cb",
+    )
+
     def __init__(
         self,
         raw_message: str | None = None,
         target: str | None = None,
         content: str | None = None,
         cb: Callable | None = None,
+        channel: str | None = None,
     ) -> None:
         assert (
             raw_message is not None or content is not None
         ), "Message Error: either raw_message or content must be specified"
-        self.error = None
-        self.sender = None
+        self.raw_message = raw_message
+        self.tags: dict[str, str] = {}
+        self.prefix: str | None = None
+        self.sender: str | None = None
+        self.command: str | None = None
+        self.params: list[str] = []
+        self.channel = channel
+        self.error: str | None = None
         self.cb = cb
+        self.target = target
+        self.content = content
         if raw_message:
-            self.raw_message = raw_message
+            self.target = None
+            self.content = None
             self.parse()
-        else:
-            self.target = target
-            self.content = content
 
     def is_priv(self) -> bool:
         """Check if the message is a private message"""
-        if self.raw_message is None:
-            return False
-        v_command = "PRIVMSG" in self.raw_message
-        v_channel = c.CHANNEL in self.raw_message
-        v_sender = self.sender is not None
-        return v_command and v_channel and v_sender
+        return (
+            self.command == "PRIVMSG"
+            and self.sender is not None
+            and self.channel is not None
+            and self.channel.lower() in c.JOINED
+        )
 
     def is_for_bot(self) -> bool:
         """Check if the message is for the bot"""
-        if self.raw_message is None:
-            return False
-        v_target = self.target == c.NICKNAME
-        return self.is_priv() and v_target
+        return self.target == c.NICKNAME and self.is_priv()
 
     def parse(self) -> None:
-        """Parse the raw message (internal use only)"""
-        error_match = re.match(r"^ERROR(?:\s*:(?P<content>.*))?$", self.raw_message)
-        if error_match is not None:
-            self.error = error_match.group("content")
-            self.error = self.error if self.error else "something broke"
+        """
+        Parse the raw message into tags, prefix, command and params in a
+        single pass (internal use only)
+        """
+        assert self.raw_message is not None
+        line = self.raw_message
+
+        if line.startswith("@"):
+            tags, _, line = line[1:].partition(" ")
+            self.tags = parse_tags(tags)
+            line = line.lstrip(" ")
+
+        if line.startswith(":"):
+            prefix, _, line = line[1:].partition(" ")
+            self.prefix = prefix
+            nick, bang, _ = prefix.partition("!")
+            self.sender = nick if bang and nick else None
+            line = line.lstrip(" ")
+
+        head, trailing_sep, trailing = line.partition(" :")
+        params = head.split()
+        if trailing_sep:
+            params.append(trailing)
+        self.command = params.pop(0).upper() if params else ""
+        self.params = params
+
+        if self.command == "ERROR":
+            self.error = params[-1] if params and params[-1] else "something broke"
             return
 
-        sender_match = re.match(r"^:([A-Za-z0-9-_@&$()/]+)!.*$", self.raw_message)
-        main_match = re.search(
-            rf".*PRIVMSG {c.CHANNEL} :(?:(?P<target>[^\s]+):\s*)?(?P<content>.*)\s*$",
-            self.raw_message,
-        )
+        if self.command == "PRIVMSG" and len(params) >= 2:
+            self.channel = params[0]
+            self.parse_content(params[1])
 
-        self.sender = sender_match.group(1) if sender_match else None
-        self.target = main_match.group("target") if main_match else None
-        self.content = main_match.group("content") if main_match else None
+    def parse_content(self, text: str) -> None:
+        """Split an optional `target:` addressee off PRIVMSG text (internal use only)"""
+        first, _, _ = text.partition(" ")
+        colon = first.rfind(":")
+        if colon > 0:
+            self.target = first[:colon]
+            self.content = text[colon + 1 :].lstrip()
+        else:
+            self.content = text
 
     def assemble(self) -> str:
         """Assemble the message"""
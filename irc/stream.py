@@ -0,0 +1,44 @@
+"""Incremental line framing for the IRC byte stream"""
+
+
+class LineBuffer:
+    """
+    Persistent receive buffer that turns arbitrary recv chunks into complete
+    IRC lines. Lines split across chunks are held back until their terminator
+    arrives, and each byte is searched for a terminator only once.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, chunk: bytes | bytearray | memoryview) -> list[bytes]:
+        """
+        Append a chunk and return every line it completed.
+        Args:
+        - `chunk` (`bytes | bytearray | memoryview`): Raw bytes from the socket.
+        Returns:
+        - `list[bytes]`: Complete lines, without their CRLF (or bare LF)
+          terminators. Empty lines are dropped.
+        """
+        buffer = self.buffer
+        # only the new bytes can contain a terminator we haven't seen yet
+        search_from = len(buffer)
+        buffer += chunk
+
+        lines = []
+        start = 0
+        pos = buffer.find(b"\n", search_from)
+        while pos != -1:
+            end = pos - 1 if pos > start and buffer[pos - 1] == 13 else pos
+            if end > start:
+                lines.append(bytes(buffer[start:end]))
+            start = pos + 1
+            pos = buffer.find(b"\n", start)
+
+        if start:
+            del buffer[:start]
+        return lines
+
+    def pending(self) -> int:
+        """Number of buffered bytes belonging to an incomplete line"""
+        return len(self.buffer)
@@ -0,0 +1,243 @@
+"""
+Binary inverted index over the song verses.
+
+The index is stored in CSR form in a directory:
+    vocab.txt     sorted terms, one per line; a term's line number is its id
+    offsets.npy   int64[n_terms + 1], postings of term `i` are
+                  `postings[offsets[i]:offsets[i + 1]]`
+    postings.npy  uint32 verse row ids, concatenated in term id order
+    df.npy        uint32[n_terms], number of distinct verses of each term
+    tf_max.npy    uint32[n_terms], most times a single verse appears in the
+                  postings of each term
+    meta.json     format version and sizes
+The arrays are memory-mapped, so opening the index only reads the vocabulary
+and the postings are paged in as they are looked up.
+
+Build it from the JSON index with `python -m music.index`.
+"""
+from __future__ import annotations
+
+import json
+import os
+from collections import Counter
+from typing import Iterator
+
+from bot.commands.helpers import lazy_import
+from music import storage
+
+np = lazy_import("numpy")
+
+FORMAT_VERSION = 3
+JSON_PATH = "music/inverse_index.json"
+INDEX_DIR = "music/inverse_index"
+
+
+class InvertedIndex:
+    """Read-only, memory-mapped term -> verse row ids index"""
+
+    def __init__(self, path: str = INDEX_DIR):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format in {path}: {meta}")
+        with open(os.path.join(path, "vocab.txt"), encoding="utf-8") as f:
+            terms = f.read().split("\n")[: meta["terms"]]
+        self.path = path
+        self.terms: list[str] = terms
+        self.ids: dict[str, int] = {term: i for i, term in enumerate(terms)}
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.postings = np.load(os.path.join(path, "postings.npy"), mmap_mode="r")
+        self.df = np.load(os.path.join(path, "df.npy"))
+        self.tf_max = np.load(os.path.join(path, "tf_max.npy"))
+        self.docs: int = meta["docs"]
+        # Whether terms keep their apostrophes ("don't"), so queries are
+        # tokenized the same way
+        apostrophes = meta.get("apostrophes")
+        if apostrophes is None:
+            apostrophes = any("'" in term for term in terms)
+        self.apostrophes: bool = apostrophes
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def __contains__(self, term: str) -> bool:
+        return term in self.ids
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.terms)
+
+    def __getitem__(self, term: str):
+        return self.postings_of(self.ids[term])
+
+    def get(self, term: str, default=None):
+        """Postings of `term`, or `default` if it isn't indexed"""
+        term_id = self.ids.get(term)
+        return default if term_id is None else self.postings_of(term_id)
+
+    def postings_of(self, term_id: int):
+        """Verse row ids of the term with id `term_id`, as a uint32 array view"""
+        return self.postings[self.offsets[term_id] : self.offsets[term_id + 1]]
+
+    @classmethod
+    def open(cls, path: str = INDEX_DIR, json_path: str = JSON_PATH) -> InvertedIndex:
+        """
+        Open the index at `path`, building it from `json_path` first if it
+        doesn't exist, is older than the JSON or has an outdated format.
+        """
+        return storage.open_store(cls, convert, path, json_path)
+
+    def best_matches(self, words: list[str], max_df: int | None = None):
+        """
+        Ids of the verses with the most postings among those of `words`
+        (counted with repetition), in order of first appearance in the
+        postings of the words, in query order.
+
+        Terms are read rarest first and the search stops as soon as the
+        leading verse can't be caught by the terms left. With `max_df`, only
+        the first `max_df` postings of a term are read: which verses a common
+        word counts for then depends on the order of its postings in the
+        index (ascending verse ids for an index built in row order).
+
+        Args:
+        - `words` (`list[str]`): Query terms, already normalized like the
+          index terms.
+        - `max_df` (`int | None`): Number of postings read per term, all of
+          them if `None`.
+
+        Returns:
+        - `numpy.ndarray`: uint32 verse ids, empty if no word is indexed.
+        """
+        weights = Counter(word for word in words if word in self.ids)
+        if len(weights) == 0:
+            return np.empty(0, dtype=np.uint32)
+        # (postings read, word), rarest first
+        plan = []
+        for word in weights:
+            term_id = self.ids[word]
+            length = int(self.offsets[term_id + 1] - self.offsets[term_id])
+            plan.append((length if max_df is None else min(length, max_df), word))
+        plan.sort()
+        # Most a term can add to the count of a single verse
+        gains = {
+            word: weight * int(self.tf_max[self.ids[word]])
+            for word, weight in weights.items()
+        }
+        # Position of each word in the query (a Counter keeps first appearances)
+        positions = {word: i for i, word in enumerate(weights)}
+
+        seen = []
+        left = sum(gains.values())
+        pending = sum(length for length, _ in plan)
+        volume = 0
+        # Leader and runner-up counts at the last check, and the most the
+        # leader has gained from the terms read since then
+        best = runner = added = 0
+        for length, word in plan:
+            postings = self.postings_of(self.ids[word])[:max_df]
+            seen.extend([(positions[word], postings)] * weights[word])
+            left -= gains[word]
+            pending -= length
+            volume += length * weights[word]
+            added += gains[word]
+            # Checking costs about as much as the postings seen so far, so
+            # it's only worth it when more than that is left to read. Counts
+            # only grow, so the runner-up can't have fallen since the last
+            # check, and the leader has gained at most `added`
+            if left == 0 or pending <= volume or best + added <= runner + left:
+                continue
+            # Stop once a single verse leads by more than the terms left can
+            # add to any other verse
+            ids = np.concatenate([postings for _, postings in seen])
+            ids, counts = np.unique(ids, return_counts=True)
+            leader = counts.argmax()
+            best = counts[leader]
+            counts[leader] = 0
+            runner = counts.max(initial=0)
+            added = 0
+            if runner + left < best:
+                return ids[leader : leader + 1]
+
+        seen.sort(key=lambda entry: entry[0])
+        ids = np.concatenate([postings for _, postings in seen])
+        counts = np.bincount(ids)
+        return unique_in_order(ids[counts[ids] == counts.max()])
+
+    def coverage(self, words: list[str], song_ids, max_df: int | None = None):
+        """
+        Share of `words` (counted with repetition) found in each verse of
+        `song_ids`, reading only the first `max_df` postings of each word
+        like `best_matches` does (so with `max_df`, it depends on the order
+        of the postings too)
+
+        Returns:
+        - `numpy.ndarray`: float32 shares, aligned with `song_ids`.
+        """
+        weights = Counter(word for word in words if word in self.ids)
+        counts = np.zeros(len(song_ids), dtype=np.float32)
+        for word, weight in weights.items():
+            counts += weight * np.isin(song_ids, self[word][:max_df])
+        return counts / max(sum(weights.values()), 1)
+
+
+def unique_in_order(ids):
+    """Distinct values of `ids`, in order of first appearance"""
+    _, first = np.unique(ids, return_index=True)
+    return ids[np.sort(first)]
+
+
+def convert(json_path: str = JSON_PATH, path: str = INDEX_DIR) -> None:
+    """
+    Build the binary index at `path` from the JSON index at `json_path`.
+    Postings keep the JSON's order and duplicates, so lookups are unchanged.
+
+    Args:
+    - `json_path` (`str`): JSON object mapping each term to a list of row ids.
+    - `path` (`str`): Directory to write the index to, replaced once it's
+      complete.
+    """
+    with open(json_path) as f:
+        inverse_index: dict[str, list[int]] = json.load(f)
+
+    terms = sorted(inverse_index)
+    if any("\n" in term for term in terms):
+        raise ValueError("Index terms can't contain newlines")
+    lengths = np.fromiter(
+        (len(inverse_index[term]) for term in terms), dtype=np.int64, count=len(terms)
+    )
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    postings = np.empty(int(offsets[-1]), dtype=np.uint32)
+    df = np.empty(len(terms), dtype=np.uint32)
+    tf_max = np.ones(len(terms), dtype=np.uint32)
+    for i, term in enumerate(terms):
+        postings[offsets[i] : offsets[i + 1]] = inverse_index[term]
+        df[i] = len(set(inverse_index[term]))
+        if df[i] < lengths[i]:
+            tf_max[i] = max(Counter(inverse_index[term]).values())
+
+    with storage.building(path) as tmp:
+        with open(os.path.join(tmp, "vocab.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(terms))
+        np.save(os.path.join(tmp, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp, "postings.npy"), postings)
+        np.save(os.path.join(tmp, "df.npy"), df)
+        np.save(os.path.join(tmp, "tf_max.npy"), tf_max)
+        docs = int(postings.max()) + 1 if len(postings) else 0
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            meta = {"version": FORMAT_VERSION, "terms": len(terms), "docs": docs}
+            apostrophes = any("'" in term for term in terms)
+            meta |= {"postings": len(postings), "apostrophes": apostrophes}
+            json.dump(meta, f)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the binary inverted index")
+    parser.add_argument("-i", "--input", default=JSON_PATH, help="JSON index")
+    parser.add_argument("-o", "--output", default=INDEX_DIR, help="index directory")
+    args = parser.parse_args()
+
+    convert(args.input, args.output)
+    index = InvertedIndex(args.output)
+    print(f"Wrote {len(index)} terms, {len(index.postings)} postings to {args.output}")
@@ -1,17 +1,45 @@
 """Music module for the bot"""
-import json
+from __future__ import annotations
+
 import random
-import re
-from collections import Counter
 from enum import Enum
+from typing import TYPE_CHECKING
 
-import pandas as pd
-import torch.nn.functional as F
 from bot.commands import embeddings as em
+from bot.commands.helpers import lazy_import
 from irc.message import Message
-from nltk.stem import PorterStemmer
-
-porter_stemmer = PorterStemmer()
+from music.index import InvertedIndex, unique_in_order
+from music.semantic import VerseIndex
+from music.songs import SongStore
+from music.text import tokenize
+
+np = lazy_import("numpy")
+
+if TYPE_CHECKING:
+    from bot.commands.commands import Context
+
+# Fraction of the verses a word's postings are read for in searches; words
+# found in more verses only count for part of them. Off (`None`) by default,
+# as capping changes which verses common words match
+MAX_DF: float | None = None
+# Weight of the embedding similarity in the hybrid verse score of semantic
+# retrieval; the rest is the share of the message's words found in the verse
+SEMANTIC_WEIGHT = 0.5
+# Verses retrieved by embedding similarity for each message
+SEMANTIC_K = 20
+# Lexical candidates re-ranked by the similarity of their shortened verse
+RERANK_K = 8
+# Weight of a song's popularity (its percentile rank / 100) in the re-ranking,
+# added to its similarity
+POPULARITY_WEIGHT = 0.1
+# Shortened verses less similar to the message than this are never sung
+MIN_SIMILARITY = 0.2
+
+
+def percentile_ranks(views: np.ndarray) -> np.ndarray:
+    """Percentage of all songs with fewer views than each song, as float32"""
+    ranks = np.sort(views).searchsorted(views, side="left")
+    return (ranks / max(len(views), 1) * 100).astype(np.float32)
 
 
 class SongInfo(Enum):
@@ -37,122 +65,189 @@ class Stanza:
 class MusicHandler:
     """Class for handling music"""
 
-    def __init__(self):
-        self.cur_stanza: Stanza | None = None
-        self.inverse_index: dict | None = None
-        self.exploded_song_df: pd.DataFrame | None = None
-
-        self.inverse_index, self.exploded_song_df = self.read_files()
-
-    def forget(self):
-        """Forget the current stanza"""
-        self.cur_stanza = None
-
-    def next_stanza(self, message: Message) -> Stanza | None:
-        """Get the next stanza if available"""
+    def __init__(self, max_df: float | None = MAX_DF, semantic: bool = False):
+        self.max_df = max_df
+        self.semantic = semantic
+        self.verse_index: VerseIndex | None = None
+        self.inverse_index: InvertedIndex | None = None
+        self.songs: SongStore | None = None
+        self.views: np.ndarray | None = None
+        self.percentiles: np.ndarray | None = None
+
+    def load(self) -> None:
+        """Read the song data, if it hasn't been read yet"""
+        if self.inverse_index is None or self.songs is None:
+            self.inverse_index, self.songs = self.read_files()
+            self.views = self.songs.views
+            self.percentiles = percentile_ranks(self.views)
+        if self.semantic and self.verse_index is None:
+            self.verse_index = self.read_verse_index()
+
+    def next_stanza(
+        self, message: Message, context: Context | None = None
+    ) -> Stanza | None:
+        """
+        Get the next stanza if available. `context`, the command context of
+        `message`, holds the message's embedding, so it is computed at most
+        once per message (and together with the verses when it's first
+        needed here).
+        """
         phrase = message.content
         assert phrase is not None
-
-        verse = self.get_verse(phrase, self.inverse_index, self.exploded_song_df)
-        if verse is None:
+        self.load()
+
+        song_ids = self.get_verses(phrase, self.inverse_index, self.views, context)
+        assert self.songs is not None and self.percentiles is not None
+        candidates = []
+        for song_id in song_ids:
+            shortened_verse = self.shorten_verse(phrase, song_id)
+            if shortened_verse is not None:
+                lines = [shortened_verse]
+            elif self.verse_index is not None:
+                # found by meaning alone, sharing no word with the phrase:
+                # every line competes, and the most similar one is sung
+                lines = self.songs.lines(song_id)
+            else:
+                continue
+            for line in lines:
+                line = (line + "...").strip()
+                if len(line) >= 15:
+                    candidates.append((song_id, line))
+        if len(candidates) == 0:
             return None
-        shortened_verse = self.shorten_verse(phrase, verse["verse"])
-        if shortened_verse is None:
-            return None
-
-        assert self.inverse_index is not None
-        assert self.exploded_song_df is not None
 
-        shortened_verse = (shortened_verse + "...").strip()
-
-        percentile = self.get_song_percentile(
-            verse["views"], self.exploded_song_df["views"]
+        # all the candidate lines are embedded in one batch, and the best one
+        # that's similar enough is picked, favoring popular songs
+        similarity = self.get_similarity_scores(
+            phrase, [verse for _, verse in candidates], context
         )
-
-        assert isinstance(shortened_verse, str)
-
-        similarity_score = self.get_similarity_score(phrase, shortened_verse)
-        if (
-            similarity_score > 0.2
-            and random.randint(0, 100) < percentile
-            and len(shortened_verse) >= 15
-        ):
-            self.cur_stanza = Stanza(
-                str(verse["title"]),
-                str(verse["artist"]),
-                str(verse["year"]),
-                str(verse["genre"]),
-                str(shortened_verse),
-            )
-        else:
+        popularity = self.percentiles[[song_id for song_id, _ in candidates]] / 100
+        score = np.where(
+            similarity > MIN_SIMILARITY,
+            similarity + POPULARITY_WEIGHT * popularity,
+            -np.inf,
+        )
+        best = int(score.argmax())
+        if score[best] == -np.inf:
             return None
+        song_id, shortened_verse = candidates[best]
 
-        if len(self.cur_stanza.stanza) < 15:
+        percentile = self.get_song_percentile(song_id)
+        if random.randint(0, 100) >= percentile:
             return None
-        return self.cur_stanza
 
-    def read_files(self):
-        with open("music/inverse_index.json") as f:
-            inverse_index = json.load(f)
-        exploded_song_df = pd.read_csv("music/exploded_song_df.csv")
-        return inverse_index, exploded_song_df
-
-    def get_common_verses(self, words, inverse_index):
-        songs = []
-        for word in words:
-            if word in inverse_index:
-                songs.extend(inverse_index[word])
+        verse = self.songs.row(song_id)
+        return Stanza(
+            str(verse["title"]),
+            str(verse["artist"]),
+            str(verse["year"]),
+            str(verse["genre"]),
+            str(shortened_verse),
+        )
 
-        return songs
+    def read_files(self):
+        inverse_index = InvertedIndex.open()
+        songs = SongStore.open()
+        return inverse_index, songs
+
+    def read_verse_index(self) -> VerseIndex | None:
+        """Open the semantic verse index, or turn semantic retrieval off"""
+        try:
+            verse_index = VerseIndex.open()
+        except FileNotFoundError:
+            print("No verse index, build it with `python -m music.semantic`")
+        else:
+            if verse_index.model == em.MODEL_NAME:
+                return verse_index
+            print(f"The verse index was built with {verse_index.model}, rebuild it")
+        self.semantic = False
+        return None
 
     def get_familiar_songs(self, phrase, inverse_index):
-        words = phrase.lower().split()
-        song_ids = self.get_common_verses(words, inverse_index)
-
-        counter = Counter(song_ids)
-        most_common = counter.most_common(1)
-        if len(most_common) == 0:
-            return []
-        max_count = most_common[0][1]
-        song_ids = [item for item, count in counter.items() if count == max_count]
-
-        return song_ids
+        """
+        Ids of the verses matching the most words of `phrase`, reading the
+        postings of each word for at most `self.max_df` of the verses
+        """
+        words = tokenize(phrase, inverse_index.apostrophes)
+        return inverse_index.best_matches(words, self.posting_cap(inverse_index))
+
+    def posting_cap(self, inverse_index):
+        """Number of postings read per word, or `None` to read them all"""
+        if self.max_df is None:
+            return None
+        return max(1, int(self.max_df * inverse_index.docs))
+
+    def get_most_popular_songs(self, song_ids, views, k):
+        """
+        Ids of the `k` most viewed songs in `song_ids`, most viewed first and
+        in their original order on ties
+        """
+        candidate_views = views[song_ids]
+        top = np.arange(len(song_ids))
+        if len(song_ids) > k:
+            # only the top `k` are sorted; on ties with the k-th most viewed,
+            # the first ones are kept
+            kth = np.partition(candidate_views, len(song_ids) - k)[len(song_ids) - k]
+            above = np.flatnonzero(candidate_views > kth)
+            tied = np.flatnonzero(candidate_views == kth)[: k - len(above)]
+            top = np.sort(np.concatenate([above, tied]))
+        return song_ids[top[np.argsort(-candidate_views[top], kind="stable")]]
+
+    def get_semantic_songs(self, phrase, song_ids, phrase_embedding):
+        """
+        Add the verses closest to the phrase's embedding to the lexical
+        matches `song_ids`, and rank them all by their hybrid score
+        """
+        assert self.verse_index is not None and self.inverse_index is not None
+        _, similar_ids = self.verse_index.search(phrase_embedding, SEMANTIC_K)
+        song_ids = unique_in_order(np.concatenate([song_ids, similar_ids]))
+        if len(song_ids) == 0:
+            return song_ids
 
-    def get_most_popular_song(self, song_ids, exploded_song_df):
-        df = exploded_song_df.iloc[song_ids]
-        return df.sort_values("views", ascending=False).iloc[0]
+        max_df = self.posting_cap(self.inverse_index)
+        words = tokenize(phrase, self.inverse_index.apostrophes)
+        shared = self.inverse_index.coverage(words, song_ids, max_df)
+        similarity = self.verse_index.similarities(phrase_embedding, song_ids)
+        score = SEMANTIC_WEIGHT * similarity + (1 - SEMANTIC_WEIGHT) * shared
+        return song_ids[np.argsort(-score, kind="stable")]
 
-    def get_verse(self, phrase, inverse_index, exploded_song_df):
-        phrase = porter_stemmer.stem(phrase)
+    def get_verses(self, phrase, inverse_index, views, context=None):
+        """Ids of the (at most `RERANK_K`) best verses to reply to `phrase` with"""
         song_ids = self.get_familiar_songs(phrase, inverse_index)
-        if len(song_ids) == 0:
+        if self.verse_index is None:
+            return self.get_most_popular_songs(song_ids, views, RERANK_K)
+        embedding = context.message_embedding() if context else em.embed(phrase)
+        return self.get_semantic_songs(phrase, song_ids, embedding)[:RERANK_K]
+
+    def get_song_percentile(self, song_id):
+        """Percentage of songs with fewer views than the song `song_id`"""
+        assert self.percentiles is not None
+        return float(self.percentiles[song_id])
+
+    def shorten_verse(self, phrase, song_id):
+        """
+        Line of the verse of `song_id` sharing the most words with `phrase`
+        (the first such line on ties), or None if it shares none
+        """
+        first, counts = self.songs.line_matches(song_id, tokenize(phrase))
+        if len(counts) == 0 or counts.max() <= 0:
             return None
-        verse = self.get_most_popular_song(song_ids, exploded_song_df)
-        return verse
-
-    def get_song_percentile(self, song_views, views_col):
-        p = views_col.values.searchsorted(song_views) / len(views_col) * 100
-        return p
-
-    def shorten_verse(self, phrase, verse):
-        words = phrase.lower().split()
-        lines = re.split("[,()]", verse)
-
-        max_word_count = 0
-        line_with_most_words = None
-
-        for line in lines:
-            word_count = sum(1 for word in words if word.lower() in line.lower())
-            if word_count > max_word_count:
-                max_word_count = word_count
-                line_with_most_words = line
-
-        return line_with_most_words
-
-    def get_similarity_score(self, phrase, verse):
-        p_em = em.embed(phrase)
-        v_em = em.embed(verse)
-        return F.cosine_similarity(p_em, v_em, dim=0)
+        return self.songs.line(first + int(counts.argmax()))
+
+    def get_similarity_scores(self, phrase, verses, context=None):
+        """
+        Cosine similarities of `phrase` to each of `verses`, embedding them in
+        one batch, along with the phrase unless `context` already holds its
+        embedding (it is stored there otherwise)
+        """
+        if context is not None and context.latest_embedding is not None:
+            p_em, v_ems = context.latest_embedding, em.embed_batch(verses)
+        else:
+            embeddings = em.embed_batch([phrase, *verses])
+            p_em, v_ems = embeddings[0], embeddings[1:]
+            if context is not None:
+                context.latest_embedding = p_em
+        return (em.normalize(v_ems) @ em.normalize(p_em)).numpy()
 
 
 if __name__ == "__main__":
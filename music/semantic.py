@@ -0,0 +1,233 @@
+"""
+Semantic verse retrieval: verse embeddings are computed offline and searched
+with an inverted-file (IVF) index, so paraphrases of lyrics can match verses
+that share few words with them.
+
+Verses are clustered around `nlist` centroids (spherical k-means); a search
+only scores the verses of the `nprobe` clusters closest to the query. The
+index is a directory:
+    centroids.npy  float32[nlist, d] L2-normalized cluster centroids
+    offsets.npy    int64[nlist + 1], cluster `c` holds rows
+                   `offsets[c]:offsets[c + 1]` of `ids` and `vectors`
+    ids.npy        uint32[n] verse ids, grouped by cluster
+    vectors.npy    float32[n, d] L2-normalized verse embeddings, in the same
+                   order, memory-mapped (float32 so clusters are scored
+                   in place, without a conversion copy)
+    meta.json      format version, embedding model and sizes
+
+Build it from the song store with `python -m music.semantic`; this embeds
+every verse, which takes a while on CPU.
+"""
+from __future__ import annotations
+
+import json
+import os
+
+from bot.commands import embeddings as em
+from bot.commands.helpers import lazy_import
+from music import storage
+from music.songs import STORE_DIR, SongStore
+
+np = lazy_import("numpy")
+
+FORMAT_VERSION = 1
+INDEX_DIR = "music/verse_index"
+# Clusters scored per query; more is slower but finds more of the true neighbors
+NPROBE = 16
+# Spherical k-means settings used to build the index
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 100_000
+# Rows embedded or assigned to clusters at a time while building
+BUILD_BATCH = 8192
+
+
+class VerseIndex:
+    """Read-only IVF index of verse embeddings"""
+
+    def __init__(self, path: str = INDEX_DIR):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported verse index format in {path}: {meta}")
+        self.path = path
+        self.model: str = meta["model"]
+        self.centroids = np.load(os.path.join(path, "centroids.npy"))
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        # copy-on-write, so torch can wrap clusters of it (it's never written)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="c")
+        # row of each verse id in `vectors`
+        self.rows = np.empty(meta["verses"], dtype=np.int64)
+        self.rows[self.ids] = np.arange(len(self.ids))
+
+    @classmethod
+    def open(cls, path: str = INDEX_DIR) -> VerseIndex:
+        """Open the index at `path`, waiting for a build of it in progress"""
+        with storage.locked(path):
+            return cls(path)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query, k: int = 10, nprobe: int = NPROBE):
+        """
+        Find the verses most similar to an embedding.
+
+        Args:
+        - `query` (`numpy.ndarray`): A (d) embedding of the query, normalized
+          or not.
+        - `k` (`int`): Number of verses to return.
+        - `nprobe` (`int`): Number of clusters to score.
+
+        Returns:
+        - `numpy.ndarray, numpy.ndarray`: float32 cosine similarities in
+          descending order, and the uint32 ids of their verses. Fewer than
+          `k` if the probed clusters hold fewer verses.
+        """
+        query = unit(np.asarray(query, dtype=np.float32))
+        closeness = self.centroids @ query
+        nprobe = min(nprobe, len(closeness))
+        probed = np.argpartition(-closeness, nprobe - 1)[:nprobe]
+
+        spans = [(self.offsets[c], self.offsets[c + 1]) for c in probed]
+        rows = np.concatenate([np.arange(begin, end) for begin, end in spans])
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.uint32)
+        # the probed clusters are scored in place, as blocks of one matrix
+        clusters = [
+            em.torch.from_numpy(self.vectors[begin:end]) for begin, end in spans
+        ]
+        scores, best = em.top_k(
+            em.torch.from_numpy(query), clusters, k, normalized=True
+        )
+        return scores.numpy(), self.ids[rows[best.numpy()]]
+
+    def similarities(self, query, song_ids):
+        """Exact cosine similarities of an embedding to the verses `song_ids`"""
+        query = unit(np.asarray(query, dtype=np.float32))
+        rows = self.rows[song_ids]
+        order = np.argsort(rows)
+        scores = np.empty(len(rows), dtype=np.float32)
+        scores[order] = self.vectors[rows[order]] @ query
+        return scores
+
+
+def unit(matrix):
+    """L2-normalize a vector, or each row of a matrix, leaving zeros as they are"""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def train_centroids(vectors, nlist: int, seed: int = 0):
+    """
+    Spherical k-means over a sample of `vectors`.
+
+    Args:
+    - `vectors` (`numpy.ndarray`): An (n × d) matrix of L2-normalized
+      embeddings, may be memory-mapped.
+    - `nlist` (`int`): Number of clusters.
+    - `seed` (`int`): Seed of the sampling and of the initial centroids.
+
+    Returns:
+    - `numpy.ndarray`: float32 (nlist × d) L2-normalized centroids.
+    """
+    rng = np.random.default_rng(seed)
+    size = min(len(vectors), max(KMEANS_SAMPLE, nlist))
+    sample = np.sort(rng.choice(len(vectors), size, replace=False))
+    sample = np.asarray(vectors[sample], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+
+    for _ in range(KMEANS_ITERATIONS):
+        labels = assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        # clusters that lost all their points restart from a random point
+        empty = np.bincount(labels, minlength=nlist) == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = unit(sums)
+    return centroids
+
+
+def assign(vectors, centroids):
+    """Index of the closest centroid to each row of `vectors`"""
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for begin in range(0, len(vectors), BUILD_BATCH):
+        batch = np.asarray(vectors[begin : begin + BUILD_BATCH], dtype=np.float32)
+        labels[begin : begin + len(batch)] = (batch @ centroids.T).argmax(axis=1)
+    return labels
+
+
+def build(vectors, path: str = INDEX_DIR, nlist: int | None = None) -> None:
+    """
+    Cluster verse embeddings and write the IVF index at `path`.
+
+    Args:
+    - `vectors` (`numpy.ndarray`): An (n × d) matrix of L2-normalized
+      embeddings, row `i` being verse `i`; may be memory-mapped.
+    - `path` (`str`): Directory to write the index to, replaced once it's
+      complete.
+    - `nlist` (`int | None`): Number of clusters, about √n by default.
+    """
+    nlist = nlist or max(1, round(len(vectors) ** 0.5))
+    centroids = train_centroids(vectors, min(nlist, len(vectors)))
+    labels = assign(vectors, centroids)
+    order = np.argsort(labels, kind="stable")
+    offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=len(centroids)), out=offsets[1:])
+
+    with storage.building(path) as tmp:
+        np.save(os.path.join(tmp, "centroids.npy"), centroids)
+        np.save(os.path.join(tmp, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp, "ids.npy"), order.astype(np.uint32))
+        grouped = np.lib.format.open_memmap(
+            os.path.join(tmp, "vectors.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(vectors), vectors.shape[1]),
+        )
+        for begin in range(0, len(order), BUILD_BATCH):
+            rows = order[begin : begin + BUILD_BATCH]
+            # read in ascending order, which is much faster on a mapped file
+            ranks = np.argsort(np.argsort(rows))
+            grouped[begin : begin + len(rows)] = vectors[np.sort(rows)][ranks]
+        grouped.flush()
+        del grouped
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            meta = {"version": FORMAT_VERSION, "model": em.MODEL_NAME}
+            json.dump(meta | {"verses": len(vectors), "nlist": len(centroids)}, f)
+
+
+def embed_verses(songs: SongStore, path: str):
+    """
+    Embed every verse of `songs` into a float32 matrix at `path`, in batches,
+    and return it memory-mapped
+    """
+    vectors = None
+    for begin in range(0, len(songs), BUILD_BATCH):
+        end = min(begin + BUILD_BATCH, len(songs))
+        batch = unit(em.get_model().encode([songs.verse(i) for i in range(begin, end)]))
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.float32, shape=(len(songs), batch.shape[1])
+            )
+        vectors[begin:end] = batch
+        print(f"Embedded {end}/{len(songs)} verses", end="\r")
+    print()
+    assert vectors is not None, "there are no verses to embed"
+    vectors.flush()
+    return np.load(path, mmap_mode="r")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the semantic verse index")
+    parser.add_argument("-i", "--input", default=STORE_DIR, help="song store")
+    parser.add_argument("-o", "--output", default=INDEX_DIR, help="index directory")
+    parser.add_argument("-n", "--nlist", type=int, help="number of clusters")
+    args = parser.parse_args()
+
+    embedded = args.output + ".vectors.npy"
+    build(embed_verses(SongStore.open(args.input), embedded), args.output, args.nlist)
+    os.remove(embedded)
+    print(f"Wrote {len(VerseIndex(args.output))} verses to {args.output}")
@@ -29,6 +29,9 @@ def setup():
             print(f"Downloading {fname}...")
             download(url, f"music/{fname}")
 
+    # The binary index and song store are built by `InvertedIndex.open` and
+    # `SongStore.open` when they're missing or older than these downloads
+
     print("Setup complete\n")
 
 
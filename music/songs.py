@@ -0,0 +1,268 @@
+"""
+Columnar store of the song metadata, read by row id at runtime instead of
+keeping the whole song DataFrame in memory.
+
+The store is a directory:
+    views.npy           int64 views of each song
+    years.npy           int32 release year of each song, -1 if unknown
+    artists.npy         int32 codes into the `artists` list in meta.json
+    genres.npy          int32 codes into the `genres` list in meta.json
+    titles.bin          UTF-8 titles, back to back, memory-mapped
+    title_offsets.npy   uint64[n + 1], title `i` is the bytes between offsets
+                        `i` and `i + 1`
+    verses.bin          UTF-8 verses, back to back, memory-mapped
+    verse_offsets.npy   uint64[n + 1], likewise
+    verse_lines.npy     int64[n + 1], verse `i` is lines `verse_lines[i]` up
+                        to `verse_lines[i + 1]`
+    line_spans.npy      uint64[lines, 2], begin and end of each line in
+                        verses.bin; verses are split into lines at commas
+                        and brackets
+    line_tokens.npy     uint32 ids of the distinct stemmed words of each
+                        line, concatenated
+    line_token_offsets.npy
+                        int64[lines + 1], offsets of each line's token ids
+    tokens.txt          stemmed words, one per line; a word's line number
+                        is its id
+    meta.json           format version, number of songs and the dictionaries
+
+Build it from the CSV with `python -m music.songs`.
+"""
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import re
+
+from bot.commands.helpers import lazy_import
+from music import storage
+from music.text import tokenize
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+FORMAT_VERSION = 2
+CSV_PATH = "music/exploded_song_df.csv"
+STORE_DIR = "music/songs"
+# Verses are sung one line at a time; lines end at these single-byte characters
+LINE_BREAK = re.compile("[,()]")
+
+
+class TextColumn:
+    """
+    Strings stored back to back in a UTF-8 blob, decoded one at a time. The
+    blob is memory-mapped, so only the pages of the strings read are loaded
+    and processes reading the same store share them through the page cache.
+    """
+
+    def __init__(self, blob: bytes | mmap.mmap, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        begin, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.blob[begin:end].decode("utf-8")
+
+    @classmethod
+    def load(cls, path: str, name: str) -> TextColumn:
+        """Map the `name` column of the store at `path`"""
+        with open(os.path.join(path, f"{name}s.bin"), "rb") as f:
+            # Empty files can't be mapped
+            size = os.fstat(f.fileno()).st_size
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        return cls(blob, np.load(os.path.join(path, f"{name}_offsets.npy")))
+
+
+class SongStore:
+    """Read-only song metadata, looked up by row id"""
+
+    def __init__(self, path: str = STORE_DIR):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported song store format in {path}: {meta}")
+        self.path = path
+        self.views = np.load(os.path.join(path, "views.npy"))
+        self.years = np.load(os.path.join(path, "years.npy"))
+        self.artist_codes = np.load(os.path.join(path, "artists.npy"))
+        self.genre_codes = np.load(os.path.join(path, "genres.npy"))
+        self.artists: list[str] = meta["artists"]
+        self.genres: list[str] = meta["genres"]
+        self.titles = TextColumn.load(path, "title")
+        self.verses = TextColumn.load(path, "verse")
+        self.verse_lines = np.load(os.path.join(path, "verse_lines.npy"))
+        self.line_spans = np.load(os.path.join(path, "line_spans.npy"), mmap_mode="r")
+        self.line_tokens = np.load(os.path.join(path, "line_tokens.npy"), mmap_mode="r")
+        self.line_token_offsets = np.load(
+            os.path.join(path, "line_token_offsets.npy"), mmap_mode="r"
+        )
+        with open(os.path.join(path, "tokens.txt"), encoding="utf-8") as f:
+            tokens = f.read().split("\n")[: meta["tokens"]]
+        self.token_ids: dict[str, int] = {token: i for i, token in enumerate(tokens)}
+
+    def __len__(self) -> int:
+        return len(self.views)
+
+    def title(self, song_id: int) -> str:
+        """Title of the song `song_id`"""
+        return self.titles[song_id]
+
+    def artist(self, song_id: int) -> str | None:
+        """Artist of the song `song_id`, if known"""
+        code = self.artist_codes[song_id]
+        return None if code < 0 else self.artists[code]
+
+    def year(self, song_id: int) -> int | None:
+        """Release year of the song `song_id`, if known"""
+        year = int(self.years[song_id])
+        return None if year < 0 else year
+
+    def genre(self, song_id: int) -> str | None:
+        """Genre of the song `song_id`, if known"""
+        code = self.genre_codes[song_id]
+        return None if code < 0 else self.genres[code]
+
+    def verse(self, song_id: int) -> str:
+        """Verse of the song `song_id`"""
+        return self.verses[song_id]
+
+    def line(self, line_id: int) -> str:
+        """Text of a line of a verse, as split at build time"""
+        begin, end = self.line_spans[line_id]
+        return self.verses.blob[int(begin) : int(end)].decode("utf-8")
+
+    def lines(self, song_id: int) -> list[str]:
+        """Lines of the verse of `song_id`"""
+        first, last = self.verse_lines[song_id], self.verse_lines[song_id + 1]
+        return [self.line(line_id) for line_id in range(first, last)]
+
+    def line_matches(self, song_id: int, words: list[str]):
+        """
+        Count the `words` (with repetition) found in each line of a verse.
+
+        Returns:
+        - `int, numpy.ndarray`: The id of the verse's first line, and one
+          count per line of the verse.
+        """
+        first, last = self.verse_lines[song_id], self.verse_lines[song_id + 1]
+        ids = [self.token_ids[word] for word in words if word in self.token_ids]
+        if len(ids) == 0:
+            return int(first), np.zeros(last - first, dtype=np.int64)
+        query, weights = np.unique(np.array(ids, dtype=np.uint32), return_counts=True)
+
+        bounds = self.line_token_offsets[first : last + 1]
+        tokens = self.line_tokens[bounds[0] : bounds[-1]]
+        lines = np.repeat(np.arange(last - first), np.diff(bounds))
+        found = query.searchsorted(tokens).clip(max=len(query) - 1)
+        hit = query[found] == tokens
+        counts = np.bincount(lines[hit], weights[found[hit]], minlength=last - first)
+        return int(first), counts.astype(np.int64)
+
+    def row(self, song_id: int) -> dict:
+        """All the fields of the song `song_id`, keyed like the CSV columns"""
+        return {
+            "title": self.title(song_id),
+            "artist": self.artist(song_id),
+            "year": self.year(song_id),
+            "genre": self.genre(song_id),
+            "views": int(self.views[song_id]),
+            "verse": self.verse(song_id),
+        }
+
+    @classmethod
+    def open(cls, path: str = STORE_DIR, csv_path: str = CSV_PATH) -> SongStore:
+        """
+        Open the store at `path`, building it from `csv_path` first if it
+        doesn't exist, is older than the CSV or has an outdated format.
+        """
+        return storage.open_store(cls, convert, path, csv_path)
+
+
+def write_text(path: str, name: str, values) -> list[str]:
+    """
+    Write `values` as the `name` text column of the store at `path`, and
+    return them as the strings that were written
+    """
+    texts = ["" if pd.isna(value) else str(value) for value in values]
+    encoded = [value.encode("utf-8") for value in texts]
+    lengths = np.fromiter(map(len, encoded), dtype=np.uint64, count=len(encoded))
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum(lengths, out=offsets[1:])
+    with open(os.path.join(path, f"{name}s.bin"), "wb") as f:
+        f.write(b"".join(encoded))
+    np.save(os.path.join(path, f"{name}_offsets.npy"), offsets)
+    return texts
+
+
+def write_lines(path: str, verses: list[str]) -> int:
+    """
+    Split `verses` into lines and write the line table of the store at
+    `path`, returning the number of distinct stemmed words
+    """
+    token_ids: dict[str, int] = {}
+    verse_lines, spans, tokens, token_offsets = [0], [], [], [0]
+    verse_begin = 0
+    for verse in verses:
+        begin = verse_begin
+        for line in LINE_BREAK.split(verse):
+            end = begin + len(line.encode("utf-8"))
+            spans.append((begin, end))
+            begin = end + 1  # past the line break
+            words = tokenize(line)
+            ids = {token_ids.setdefault(word, len(token_ids)) for word in words}
+            tokens.extend(sorted(ids))
+            token_offsets.append(len(tokens))
+        verse_lines.append(len(spans))
+        verse_begin += len(verse.encode("utf-8"))
+
+    np.save(os.path.join(path, "verse_lines.npy"), np.array(verse_lines, np.int64))
+    spans_array = np.array(spans, dtype=np.uint64).reshape(-1, 2)
+    np.save(os.path.join(path, "line_spans.npy"), spans_array)
+    np.save(os.path.join(path, "line_tokens.npy"), np.array(tokens, np.uint32))
+    offsets = np.array(token_offsets, np.int64)
+    np.save(os.path.join(path, "line_token_offsets.npy"), offsets)
+    with open(os.path.join(path, "tokens.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(token_ids))
+    return len(token_ids)
+
+
+def convert(csv_path: str = CSV_PATH, path: str = STORE_DIR) -> None:
+    """
+    Build the song store at `path` from the song CSV at `csv_path`.
+
+    Args:
+    - `csv_path` (`str`): CSV with title, artist, year, genre, views and verse
+      columns.
+    - `path` (`str`): Directory to write the store to, replaced once it's
+      complete.
+    """
+    df = pd.read_csv(csv_path)
+    artist_codes, artists = pd.factorize(df["artist"].astype("string"))
+    genre_codes, genres = pd.factorize(df["genre"].astype("string"))
+    years = pd.to_numeric(df["year"], errors="coerce").fillna(-1)
+
+    with storage.building(path) as tmp:
+        np.save(os.path.join(tmp, "views.npy"), df["views"].to_numpy(dtype=np.int64))
+        np.save(os.path.join(tmp, "years.npy"), years.to_numpy(dtype=np.int32))
+        np.save(os.path.join(tmp, "artists.npy"), artist_codes.astype(np.int32))
+        np.save(os.path.join(tmp, "genres.npy"), genre_codes.astype(np.int32))
+        write_text(tmp, "title", df["title"])
+        token_count = write_lines(tmp, write_text(tmp, "verse", df["verse"]))
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            meta = {"version": FORMAT_VERSION, "songs": len(df), "tokens": token_count}
+            json.dump(meta | {"artists": list(artists), "genres": list(genres)}, f)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the song metadata store")
+    parser.add_argument("-i", "--input", default=CSV_PATH, help="song CSV")
+    parser.add_argument("-o", "--output", default=STORE_DIR, help="store directory")
+    args = parser.parse_args()
+
+    convert(args.input, args.output)
+    print(f"Wrote {len(SongStore(args.output))} songs to {args.output}")
@@ -0,0 +1,106 @@
+"""
+Building and opening the on-disk stores of the music package (the inverted
+index, the song store and the verse index), which several bots on one host
+may try to build at the same time on their first start.
+
+A store at `path` is guarded by the lock file `path.lock`: it is built into
+a temporary directory of its own next to `path`, then moved into place while
+the lock is held, and `open_store` only checks and reads stores under the
+same lock. Replacing a directory takes two renames, so a store is briefly
+missing during the swap; only readers that skip the lock can see that.
+"""
+from __future__ import annotations
+
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# Paths whose lock the current thread holds, so it can be taken again inside
+held = threading.local()
+
+
+@contextmanager
+def locked(path: str) -> Iterator[None]:
+    """Hold the build lock of the store at `path` for the block (reentrant)"""
+    path = os.path.abspath(path)
+    paths: set[str] = held.__dict__.setdefault("paths", set())
+    if path in paths:
+        yield
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        paths.add(path)
+        try:
+            yield
+        finally:
+            paths.discard(path)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+@contextmanager
+def building(path: str) -> Iterator[str]:
+    """
+    Build a store to replace the one at `path`.
+
+    Args:
+    - `path` (`str`): Directory of the store.
+
+    Returns:
+    - `str`: An empty directory of this process to write the store to; it
+      replaces `path` when the block completes, and is removed if it fails.
+    """
+    with locked(path):
+        parent = os.path.dirname(os.path.abspath(path))
+        name = os.path.basename(os.path.abspath(path))
+        tmp = tempfile.mkdtemp(prefix=f"{name}.", suffix=".tmp", dir=parent)
+        try:
+            yield tmp
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        old = path + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(path):
+            os.replace(path, old)
+        os.replace(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def open_store(
+    load: Callable[[str], T], build: Callable[[str, str], None], path: str, source: str
+) -> T:
+    """
+    Open a store, building it first if it's missing, older than its source
+    or can't be read.
+
+    Args:
+    - `load` (`Callable[[str], T]`): Reads the store at a path.
+    - `build` (`Callable[[str, str], None]`): Builds the store from a source
+      file at a path, as `build(source, path)`.
+    - `path` (`str`): Directory of the store.
+    - `source` (`str`): File the store is built from.
+
+    Returns:
+    - `T`: The store, as returned by `load`.
+    """
+    meta = os.path.join(path, "meta.json")
+    # under the lock, so another process's build is either done or not begun
+    with locked(path):
+        if os.path.exists(meta) and not (
+            os.path.exists(source) and os.path.getmtime(source) > os.path.getmtime(meta)
+        ):
+            try:
+                return load(path)
+            except (ValueError, KeyError, FileNotFoundError):
+                pass  # written by an older version of the module
+        build(source, path)
+        return load(path)
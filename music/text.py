@@ -0,0 +1,38 @@
+"""Tokenization shared by the song index, the song store and the bot"""
+from __future__ import annotations
+
+import functools
+import re
+
+from bot.commands.helpers import lazy_import
+
+nltk_stem = lazy_import("nltk.stem")
+
+# Number of stemmed tokens to remember; chat vocabulary repeats heavily
+STEM_CACHE = 16384
+TOKEN = re.compile(r"[^\W_]+(?:'[^\W_]+)*")
+
+
+@functools.cache
+def get_stemmer():
+    """Get the Porter stemmer, importing nltk on first use"""
+    return nltk_stem.PorterStemmer()
+
+
+@functools.lru_cache(maxsize=STEM_CACHE)
+def stem(token: str) -> str:
+    """Porter stem of a single lowercase token"""
+    return get_stemmer().stem(token)
+
+
+def tokenize(text: str, apostrophes: bool = True) -> list[str]:
+    """
+    Split `text` into stemmed words the way the song index was built:
+    lowercase, strip punctuation, then stem each token. Apostrophes inside
+    words ("don't") are kept unless `apostrophes` is `False`, for indexes
+    whose vocabulary has none ("dont").
+    """
+    tokens = TOKEN.findall(text.lower())
+    if not apostrophes:
+        tokens = [token.replace("'", "") for token in tokens]
+    return [stem(token) for token in tokens]
@@ -2,18 +2,35 @@
 
 import argparse
 
+from bot.commands import embeddings as em
+from bot.commands.backends import BACKENDS
 from bot.tweety import TweetyBot
 from music.setup import setup
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run the bot")
     parser.add_argument(
-        "-c", type=str, help="Channel: the channel to join", required=False
+        "-c", type=str, nargs="+", help="Channels: the channels to join", required=False
+    )
+    parser.add_argument(
+        "-b",
+        type=str,
+        choices=list(BACKENDS),
+        default=em.BACKEND,
+        help="Backend: the embedding backend to run the model with",
+    )
+    parser.add_argument(
+        "-s",
+        action="store_true",
+        help="Semantic: also find verses by meaning (see `python -m music.semantic`)",
     )
     args = parser.parse_args()
-    channel = args.c
+    channels = args.c
+
+    if args.b != em.BACKEND:
+        em.use_backend(args.b)
 
     setup()
 
-    tweety = TweetyBot(channel=channel)
+    tweety = TweetyBot(channels=channels, semantic=args.s)
     tweety.start()